@@ -1,14 +1,42 @@
-from fastapi import FastAPI, Request, HTTPException, Depends, Query
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, HTTPException, Depends, Query, Body, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, Response, PlainTextResponse
 from fastapi.routing import APIRoute
-from slowapi import Limiter
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
-from slowapi.middleware import SlowAPIMiddleware
+from starlette.concurrency import run_in_threadpool
 import requests
+import anyio
+import array
+import asyncio
+import bisect
 import hashlib
+import math
+import hmac
+import json
 import time
+import random
 import inspect
+import os
+import re
+import socket
+import threading
+import functools
+import contextlib
+import contextvars
+import email.utils
+import gzip
+import queue
+import shutil
+import signal
+import sqlite3
+import string
+import struct
+import sys
+import tracemalloc
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from types import MappingProxyType
+from urllib.parse import urlsplit, parse_qsl
+from requests.adapters import HTTPAdapter
+from urllib3.util.connection import allowed_gai_family
 from fastapi.routing import APIRoute
 
 # ✅ Allowed IPs and API keys
@@ -21,109 +49,3133 @@ VALID_API_KEYS = {
 # ✅ Setup FastAPI
 app = FastAPI()
 
-# ✅ Rate limiter (per API key)
-def api_key_func(request: Request):
-    return request.query_params.get("api_key") or get_remote_address(request)
+# ✅ API key (rate limits are per key, see "Rate limiting (GCRA)" below)
+def request_api_key(request: Request):
+    """API key from the `api_key` query param or the X-API-Key header."""
+    return request.query_params.get("api_key") or request.headers.get("x-api-key")
 
-limiter = Limiter(key_func=api_key_func)
-app.state.limiter = limiter
-app.add_exception_handler(
-    RateLimitExceeded,
-    lambda r, e: JSONResponse(status_code=429, content={
-        "code": 429,
-        "status": False,
-        "message": "Rate limit exceeded",
-        "data": {}
+# ✅ Dependency: API key + IP check
+def api_key_error(api_key, client_ip):
+    if api_key not in VALID_API_KEYS:
+        return "Invalid API key"
+
+    allowed_ip = VALID_API_KEYS[api_key]
+    if client_ip != allowed_ip:
+        return f"API key not allowed from IP {client_ip}"
+
+    return None
+
+def verify_api_key(request: Request):
+    api_key = request_api_key(request)
+    error = api_key_error(api_key, request.client.host)
+    if error:
+        raise HTTPException(status_code=401, detail=error)
+
+    return api_key
+
+# ✅ Admin endpoints (disabled unless ADMIN_API_KEY is set)
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
+
+def verify_admin_key(request: Request):
+    admin_key = request.headers.get("x-admin-key") or request.query_params.get("admin_key")
+    if not ADMIN_API_KEY or not hmac.compare_digest(admin_key or "", ADMIN_API_KEY):
+        raise HTTPException(status_code=401, detail="Invalid admin key")
+    return admin_key
+
+def safe_description(endpoint):
+    try:
+        desc = endpoint.__doc__
+        if not desc:
+            return ""
+        # Strip whitespace and replace newlines with spaces
+        return " ".join(desc.strip().split())
+    except Exception:
+        return ""
+
+@app.get("/")
+def root():
+    endpoints = []
+    for route in app.routes:
+        if isinstance(route, APIRoute):
+            path = route.path
+            methods = list(route.methods - {"HEAD", "OPTIONS"})
+
+            # ✅ use safe function
+            description = safe_description(route.endpoint)
+
+            # --- Build example URL ---
+            base_url = "https://tangyanstore.vercel.app"
+            params = []
+
+            # Add params based on function signature
+            func_params = route.dependant.query_params
+            for p in func_params:
+                if p.name == "id":
+                    params.append("id=xxxxxxxxxx")
+                elif p.name == "zone":
+                    params.append("zone=xxxx")
+
+            # always append api_key
+            params.append("api_key=xxxxx")
+
+            example = f"{base_url}{path}?{'&'.join(params)}" if params else f"{base_url}{path}?api_key=xxxxx"
+
+            endpoints.append({
+                "path": path,
+                "methods": methods,
+                "description": description,
+                "example": example
+                
+            })
+
+    return {
+        "version": "2.0",
+        "code": 200,
+        "author": "Sanjoy",
+        "contact": "91 9862622104",
+        "status": True,
+        "message": "Game IGN Checker API running",
+        "available_endpoints": endpoints
+    }
+
+
+# ✅ Helper response formatter
+def format_response(success: bool, message: str, data: dict = None, code: int = 200):
+    return {
+        "code": code,
+        "status": success,
+        "message": message,
+        "data": data or {}
+    }
+
+@app.get("/health")
+async def health_check():
+    # async on purpose: still answers when the request thread pool is saturated
+    saturation = saturation_report()
+    body = {
+        "status": "saturated" if saturation["saturated"] else "healthy",
+        "saturation": saturation,
+        "warmup": warmup_report(),
+    }
+    return JSONResponse(status_code=503 if saturation["saturated"] else 200, content=body)
+
+
+# ------------------------------
+# Upstream client (per-host limits)
+# ------------------------------
+
+UPSTREAM_TIMEOUT = 10
+UPSTREAM_HOST_LIMIT = int(os.getenv("UPSTREAM_HOST_LIMIT", "32"))      # concurrent calls per provider host
+
+# ✅ Every provider host the handlers call (extended from the routing config on reload)
+UPSTREAM_HOSTS = [
+    "www.smile.one",
+    "regionweb.vercel.app",
+    "gameidcheckerenglish.vercel.app",
+    "sanjoymrc.vercel.app",
+    "c-node-amber.vercel.app",
+    "cek-id-game.vercel.app",
+    "doublediamonds.vercel.app",
+    "bgmi-nine.vercel.app",
+    "gameopenworld.vercel.app",
+]
+
+# One pooled session: keep-alive TLS connections are reused across requests
+upstream_session = requests.Session()
+upstream_session.mount("https://", HTTPAdapter(
+    pool_connections=len(UPSTREAM_HOSTS) + 4,
+    pool_maxsize=UPSTREAM_HOST_LIMIT,
+))
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+
+def host_slot(url: str) -> threading.BoundedSemaphore:
+    """Return the semaphore capping concurrent calls to the URL's host."""
+    host = urlsplit(url).netloc
+    with _host_slots_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = _host_slots[host] = threading.BoundedSemaphore(UPSTREAM_HOST_LIMIT)
+        return slot
+
+
+def upstream_request(method: str, url: str, **kwargs):
+    """Send one upstream request with adaptive timeouts, waiting at most one timeout for a host slot."""
+    host = urlsplit(url).netloc
+    kwargs.setdefault("timeout", provider_timeouts(host, current_game.get()))
+    slot = host_slot(url)
+    try:
+        wait_for_provider(host)
+        if not slot.acquire(timeout=total_timeout(kwargs["timeout"])):
+            raise requests.exceptions.ConnectionError(f"Host limit reached for {host}")
+        # Quotas apply to every route, not only those that balance across providers
+        if not track_provider_call(host, +1):
+            slot.release()
+            raise UpstreamThrottled(f"{host} is over its per-minute quota")
+    except Exception:
+        count_attempt(False)
+        raise
+    started = time.monotonic()
+    response, status, error, timed_out = None, None, None, False
+    try:
+        raw = send_upstream(method, url, stream=True, **kwargs)
+        status = raw.status_code
+        try:
+            read_bounded_body(raw, host)
+        except Exception:
+            raw.close()
+            raise
+        response = raw
+        if is_throttle_response(response):
+            if THROTTLE_ENABLED:
+                provider_throttle(host).throttled(parse_retry_after(response.headers.get("retry-after")))
+            raise UpstreamThrottled(f"{host} answered {status}: rate limited")
+        return response
+    except Exception as e:
+        error = str(e)
+        timed_out = isinstance(e, requests.exceptions.Timeout)
+        raise
+    finally:
+        count_send()
+        slot.release()
+        track_provider_call(host, -1)
+        elapsed_ms = (time.monotonic() - started) * 1000
+        record_host_latency(host, elapsed_ms)
+        count_attempt(is_answer(status) and not error)
+        if status is not None or timed_out:
+            record_provider_latency(host, elapsed_ms)
+        if access_log:
+            log_upstream_attempt(method, url, status, error, elapsed_ms)
+        captured = current_capture.get()
+        if captured is not None:
+            captured.append(capture_upstream(method, url, kwargs.get("data"), response, error, elapsed_ms))
+
+
+UPSTREAM_MAX_BYTES = int(os.getenv("UPSTREAM_MAX_BYTES", str(64 * 1024)))
+
+# host -> body size cap in bytes (default UPSTREAM_MAX_BYTES)
+UPSTREAM_BODY_LIMITS = {
+    "doublediamonds.vercel.app": 1024 * 1024,   # returns the full products list
+}
+
+
+class UpstreamResponseError(requests.exceptions.RequestException):
+    """Provider answered with an oversized or non-JSON body."""
+
+
+def read_bounded_body(response, host: str):
+    """
+    Read a streamed upstream body into response.content, giving up as soon
+    as it is clearly not JSON or grows past the host's size cap.
+    """
+    content_type = response.headers.get("content-type", "").lower()
+    if content_type and "json" not in content_type and not content_type.startswith("text/plain"):
+        raise UpstreamResponseError(f"{host} returned non-JSON content ({content_type})")
+
+    limit = UPSTREAM_BODY_LIMITS.get(host, UPSTREAM_MAX_BYTES)
+    declared = response.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > limit:
+        raise UpstreamResponseError(f"{host} body of {declared} bytes exceeds {limit}")
+
+    chunks, size = [], 0
+    for chunk in response.iter_content(chunk_size=16 * 1024):
+        size += len(chunk)
+        if size > limit:
+            raise UpstreamResponseError(f"{host} body exceeds {limit} bytes")
+        chunks.append(chunk)
+
+    response._content = b"".join(chunks)
+    response._content_consumed = True
+
+
+def upstream_cache_key(url: str):
+    """Provider endpoint + sorted query params, so equivalent URLs share one entry."""
+    parts = urlsplit(url)
+    return parts.netloc.lower(), parts.path, tuple(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+
+
+def send_upstream(method: str, url: str, **kwargs):
+    if FAULT_RULES:
+        return inject_fault(method, url, **kwargs)
+    return upstream_session.request(method, url, **kwargs)
+
+
+# ------------------------------
+# Fault injection (test only: FAULT_INJECTION=1)
+# ------------------------------
+
+FAULT_INJECTION = os.getenv("FAULT_INJECTION", "0") == "1"
+FAULT_TYPES = {"latency", "drop", "http_5xx", "http_429", "malformed_json", "wrong_id"}
+
+# [{"host": "sanjoymrc.vercel.app" | "*", "fault": ..., "percent": 0-100,
+#   "latency_ms": ..., "status": ..., "retry_after": ...}]
+FAULT_RULES = []
+
+
+def validate_fault_rules(rules: list) -> list:
+    for rule in rules:
+        if rule.get("fault") not in FAULT_TYPES:
+            raise ValueError(f"Unknown fault {rule.get('fault')!r}; allowed: {sorted(FAULT_TYPES)}")
+        if not 0 <= float(rule.get("percent", 100)) <= 100:
+            raise ValueError("percent must be between 0 and 100")
+    return rules
+
+
+def fake_upstream_response(url: str, status: int, body: bytes, headers: dict = None) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status
+    response.url = url
+    response.headers.update({"Content-Type": "application/json", **(headers or {})})
+    response._content = body
+    response._content_consumed = True
+    return response
+
+
+def inject_fault(method: str, url: str, **kwargs):
+    """Apply the first matching fault rules for this host, else send the real request."""
+    host = urlsplit(url).netloc
+    for rule in FAULT_RULES:
+        if rule.get("host", "*") not in ("*", host) or random.uniform(0, 100) >= float(rule.get("percent", 100)):
+            continue
+
+        fault = rule["fault"]
+        if fault == "latency":
+            delay = rule.get("latency_ms", 1000) / 1000
+            read_timeout = kwargs.get("timeout")
+            read_timeout = read_timeout[1] if isinstance(read_timeout, tuple) else read_timeout
+            if read_timeout and delay >= read_timeout:
+                time.sleep(read_timeout)
+                raise requests.exceptions.ReadTimeout(f"Injected latency of {delay}s on {host}")
+            time.sleep(delay)
+            continue
+        if fault == "drop":
+            raise requests.exceptions.ConnectionError(f"Injected connection drop on {host}")
+        if fault == "http_5xx":
+            return fake_upstream_response(url, rule.get("status", 503), b'{"error":"injected"}')
+        if fault == "http_429":
+            headers = {"Retry-After": str(rule["retry_after"])} if "retry_after" in rule else {}
+            return fake_upstream_response(url, 429, b'{"message":"Too Many Requests"}', headers)
+        if fault == "malformed_json":
+            return fake_upstream_response(url, 200, b'{"status": true, "data": {')
+        if fault == "wrong_id":
+            return fake_upstream_response(url, 200, b'{"status": false, "success": false, "message": "Wrong ID"}')
+
+    return upstream_session.request(method, url, **kwargs)
+
+
+if FAULT_INJECTION and os.getenv("FAULTS_FILE"):
+    with open(os.getenv("FAULTS_FILE"), encoding="utf-8") as f:
+        FAULT_RULES[:] = validate_fault_rules(json.load(f))
+
+
+if FAULT_INJECTION:
+    @app.get("/admin/faults")
+    def get_faults(_: str = Depends(verify_admin_key)):
+        """
+        List active upstream fault injection rules.
+        """
+        return format_response(True, f"{len(FAULT_RULES)} fault rule(s) active", {"rules": FAULT_RULES})
+
+    @app.put("/admin/faults")
+    def set_faults(rules: list = Body(...), _: str = Depends(verify_admin_key)):
+        """
+        Replace the upstream fault injection rules.
+        """
+        try:
+            FAULT_RULES[:] = validate_fault_rules(rules)
+        except (ValueError, TypeError) as e:
+            return JSONResponse(status_code=400, content=format_response(False, str(e), {}, 400))
+        return format_response(True, f"{len(FAULT_RULES)} fault rule(s) active", {"rules": FAULT_RULES})
+
+    @app.delete("/admin/faults")
+    def clear_faults(_: str = Depends(verify_admin_key)):
+        """
+        Remove all upstream fault injection rules.
+        """
+        FAULT_RULES.clear()
+        return format_response(True, "Fault injection cleared", {"rules": []})
+
+
+# ------------------------------
+# Provider throttling (429 / 503 / Retry-After)
+# ------------------------------
+
+THROTTLE_ENABLED = os.getenv("THROTTLE", "1") == "1"                        # 0 = no cool-down / pacing state
+THROTTLE_COOLDOWN = float(os.getenv("THROTTLE_COOLDOWN", "30"))          # seconds without Retry-After
+THROTTLE_MAX_COOLDOWN = float(os.getenv("THROTTLE_MAX_COOLDOWN", "600"))
+THROTTLE_MAX_WAIT = float(os.getenv("THROTTLE_MAX_WAIT", "0.5"))         # longest pacing sleep per call
+THROTTLE_PACE = float(os.getenv("THROTTLE_PACE", "0.9"))                 # pace at this share of the observed rate
+THROTTLE_RELEASE = float(os.getenv("THROTTLE_RELEASE", "600"))           # quiet seconds before pacing is lifted
+THROTTLE_STATUSES = {429, 503}
+THROTTLE_BODY = re.compile(rb"too many requests|rate.?limit|quota exceeded|try again later", re.I)
+THROTTLE_BODY_MAX = 512     # only short bodies are scanned for throttle messages
+
+
+class UpstreamThrottled(requests.exceptions.ConnectionError):
+    """Provider is cooling down after rate-limiting us."""
+
+
+class ProviderThrottle:
+    """
+    Cool-down and pacing state for one provider. A throttle response puts
+    it on cool-down (Retry-After, else a doubling default) and starts a
+    token bucket at THROTTLE_PACE of the rate we were sending at; each
+    quiet minute raises the rate 10% and THROTTLE_RELEASE quiet seconds
+    remove the bucket.
+    """
+
+    def __init__(self):
+        self.cooldown_until = 0.0
+        self.strikes = 0
+        self.rate = None            # tokens/s, None = not paced
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.throttled_at = 0.0
+        self.raised_at = 0.0
+        self.sent = deque()         # send times over the last minute
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take a send slot: seconds to wait first, or -1 if cooling down / too far behind."""
+        now = time.monotonic()
+        with self.lock:
+            if now < self.cooldown_until:
+                return -1
+            self.sent.append(now)
+            while self.sent[0] < now - 60:
+                self.sent.popleft()
+            if self.rate is None:
+                return 0
+            if now - self.throttled_at >= THROTTLE_RELEASE:
+                self.rate, self.strikes = None, 0
+                return 0
+
+            quiet_minutes = int((now - self.raised_at) // 60)
+            if quiet_minutes:
+                self.rate *= 1.1 ** quiet_minutes
+                self.raised_at += quiet_minutes * 60
+            self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate) - 1
+            self.updated = now
+            if self.tokens >= 0:
+                return 0
+            wait = -self.tokens / self.rate
+            if wait > THROTTLE_MAX_WAIT:
+                self.tokens += 1
+                self.sent.pop()
+                return -1
+            return wait
+
+    def throttled(self, retry_after):
+        now = time.monotonic()
+        with self.lock:
+            self.strikes += 1
+            if retry_after is None:
+                retry_after = min(THROTTLE_COOLDOWN * 2 ** (self.strikes - 1), THROTTLE_MAX_COOLDOWN)
+            self.cooldown_until = max(self.cooldown_until, now + min(retry_after, THROTTLE_MAX_COOLDOWN))
+            observed = len(self.sent) / 60
+            if self.rate is not None:
+                observed = min(observed, self.rate)
+            self.rate = max(1 / 60, observed * THROTTLE_PACE)
+            # one call allowed as soon as the cool-down ends, then paced
+            self.tokens = 1.0
+            self.updated = self.cooldown_until
+            self.throttled_at = self.raised_at = now
+
+    def report(self) -> dict:
+        now = time.monotonic()
+        return {
+            "cooldown_s": round(max(0.0, self.cooldown_until - now), 1),
+            "paced_rps": round(self.rate, 3) if self.rate else None,
+            "strikes": self.strikes,
+        }
+
+
+provider_throttles = {}
+
+
+def provider_throttle(host: str) -> ProviderThrottle:
+    throttle = provider_throttles.get(host)
+    if throttle is None:
+        throttle = provider_throttles.setdefault(host, ProviderThrottle())
+    return throttle
+
+
+def cooling_down(host: str) -> bool:
+    throttle = provider_throttles.get(host)
+    return throttle is not None and time.monotonic() < throttle.cooldown_until
+
+
+def parse_retry_after(value):
+    """Retry-After as seconds (delta-seconds or HTTP date), or None."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_throttle_response(response) -> bool:
+    if response.status_code in THROTTLE_STATUSES:
+        return True
+    content = response.content or b""
+    if len(content) > THROTTLE_BODY_MAX or THROTTLE_BODY.search(content) is None:
+        return False
+    if not 200 <= response.status_code < 300:
+        return True
+    # A parseable success payload is an answer, whatever it says (an account named "RateLimit")
+    try:
+        json.loads(content)
+    except ValueError:
+        return True
+    return False
+
+
+def wait_for_provider(host: str):
+    """Pace outbound calls to a throttled provider; fail fast while it cools down."""
+    if not THROTTLE_ENABLED:
+        return
+    wait = provider_throttle(host).acquire()
+    if wait < 0:
+        raise UpstreamThrottled(f"{host} is rate limiting us")
+    if wait:
+        time.sleep(wait)
+
+
+# ------------------------------
+# Load balancing across equivalent providers
+# ------------------------------
+
+LB_MODE = os.getenv("LB_MODE", "p2c")      # "p2c" or "off" (always list order)
+
+# Per-provider weights and quotas come from the "balancing" section of the
+# routing config, so they hot-reload with it:
+#   "weights": host -> relative share of first attempts (default 1.0)
+#   "quotas":  host -> max upstream calls per minute before it is skipped
+
+
+def provider_weight(host: str) -> float:
+    return ROUTING["balancing"]["weights"].get(host, 1.0)
+
+
+def provider_quota(host: str):
+    return ROUTING["balancing"]["quotas"].get(host)
+
+
+host_inflight = {}
+host_minute_calls = {}     # host -> [minute, calls]
+_provider_lock = threading.Lock()
+
+
+def track_provider_call(host: str, delta: int) -> bool:
+    """
+    Count a call starting (+1) or ending (-1). A start that would exceed the
+    host's per-minute quota is refused (False) and not counted.
+    """
+    with _provider_lock:
+        if delta > 0:
+            minute = int(time.time() // 60)
+            usage = host_minute_calls.get(host)
+            if usage is None or usage[0] != minute:
+                usage = host_minute_calls[host] = [minute, 0]
+            quota = provider_quota(host)
+            if quota is not None and usage[1] >= quota:
+                return False
+            usage[1] += 1
+        host_inflight[host] = host_inflight.get(host, 0) + delta
+        return True
+
+
+def calls_this_minute(host: str) -> int:
+    usage = host_minute_calls.get(host)
+    return usage[1] if usage and usage[0] == int(time.time() // 60) else 0
+
+
+def within_quota(host: str) -> bool:
+    quota = provider_quota(host)
+    return quota is None or calls_this_minute(host) < quota
+
+
+def provider_load(host: str) -> float:
+    """Expected cost of one more call: in-flight x latency, scaled down by weight."""
+    latency = host_latency.get(host, {}).get("avg_ms", 100.0)
+    return (host_inflight.get(host, 0) + 1) * latency / provider_weight(host)
+
+
+def balance_urls(urls: list) -> list:
+    """
+    Order equivalent provider URLs for one lookup: the first attempt goes to
+    the lighter of two weighted-random candidates (power of two choices),
+    the rest keep their configured order as fallbacks. Providers over their
+    per-minute quota or cooling down after a 429 are skipped unless every
+    provider is; upstream_request refuses those calls anyway, so this only
+    saves the failed attempt.
+    """
+    if LB_MODE == "off" or len(urls) < 2:
+        return urls
+
+    candidates = [
+        url for url in urls
+        if within_quota(urlsplit(url).netloc) and not cooling_down(urlsplit(url).netloc)
+    ] or urls
+    if len(candidates) < 2:
+        return candidates
+
+    weights = [provider_weight(urlsplit(url).netloc) for url in candidates]
+    first, second = random.choices(candidates, weights=weights, k=2)
+    if provider_load(urlsplit(second).netloc) < provider_load(urlsplit(first).netloc):
+        first = second
+    return [first] + [url for url in candidates if url != first]
+
+
+def upstream_get(url: str, **kwargs):
+    """
+    GET through the shared upstream response cache. Routes that need the
+    same provider response share one fetch, and concurrent identical
+    fetches wait on the first instead of calling the provider again.
+    """
+    key = upstream_cache_key(url)
+    response = UPSTREAM_CACHE.get(key)
+    if response is not None:
+        count_attempt(True)
+        return response
+
+    with _upstream_inflight_lock:
+        future = _upstream_inflight.get(key)
+        leader = future is None
+        if leader:
+            ensure_client_connected()
+            future = _upstream_inflight[key] = Future()
+
+    if not leader:
+        try:
+            response = future.result(timeout=total_timeout(provider_timeouts(key[0])) + UPSTREAM_TIMEOUT)
+        except Exception:
+            count_attempt(False)
+            raise
+        count_attempt(is_answer(response.status_code))
+        return response
+
+    try:
+        response = upstream_request("GET", url, **kwargs)
+        if 200 <= response.status_code < 300:
+            UPSTREAM_CACHE.set(key, response, UPSTREAM_CACHE_TTL)
+        future.set_result(response)
+        return response
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _upstream_inflight_lock:
+            _upstream_inflight.pop(key, None)
+
+
+def upstream_post(url: str, **kwargs):
+    ensure_client_connected()
+    return upstream_request("POST", url, **kwargs)
+
+
+# ------------------------------
+# Client disconnects (abandon fallback chains)
+# ------------------------------
+
+CANCEL_ON_DISCONNECT = os.getenv("CANCEL_ON_DISCONNECT", "1") == "1"
+
+# Set (threading.Event) once the client of the current request has gone away,
+# or a /ws lookup has been cancelled, replaced or its socket closed
+current_disconnect = contextvars.ContextVar("current_disconnect", default=None)
+
+abandoned = {"requests": 0, "upstream_calls": 0, "disconnects": 0}
+
+
+class ClientDisconnected(requests.exceptions.ConnectionError):
+    """The caller went away; no new upstream attempt is started for it."""
+
+
+def client_gone() -> bool:
+    disconnected = current_disconnect.get()
+    return disconnected is not None and disconnected.is_set()
+
+
+def ensure_client_connected():
+    """
+    Called before starting a new upstream attempt. Fetches other requests
+    already wait on are never abandoned (they are joined, not started), and
+    an attempt that is already in flight still completes and fills the cache.
+    """
+    if client_gone():
+        abandoned["upstream_calls"] += 1
+        raise ClientDisconnected("Client disconnected")
+
+
+class DisconnectWatchMiddleware:
+    """
+    Reads the client's receive channel on behalf of lookup routes so a
+    disconnect is noticed while the (threaded) handler is still running,
+    and exposes it to that handler through `current_disconnect`. /ws sets
+    its own Event per lookup (see lookup_ws).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (
+            lookup_game_for_path(scope["path"]) or scope["path"] == "/games/discover"
+        ):
+            return await self.app(scope, receive, send)
+
+        disconnected = threading.Event()
+        messages = asyncio.Queue()
+        responded = False
+
+        async def watch():
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    if not responded:
+                        abandoned["disconnects"] += 1
+                        disconnected.set()
+                    return
+
+        async def send_wrapper(message):
+            nonlocal responded
+            if message["type"] == "http.response.start":
+                responded = True
+            await send(message)
+
+        watcher = asyncio.create_task(watch())
+        token = current_disconnect.set(disconnected)
+        try:
+            await self.app(scope, messages.get, send_wrapper)
+        finally:
+            current_disconnect.reset(token)
+            watcher.cancel()
+
+
+if CANCEL_ON_DISCONNECT:
+    app.add_middleware(DisconnectWatchMiddleware)
+
+
+# ------------------------------
+# DNS cache + connection warm-up
+# ------------------------------
+
+DNS_TTL = int(os.getenv("DNS_TTL", "300"))
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") == "1"
+WARMUP_INTERVAL = int(os.getenv("WARMUP_INTERVAL", "60"))
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "1"))   # per host
+
+_dns_cache = {}
+_dns_cache_lock = threading.Lock()
+_system_getaddrinfo = socket.getaddrinfo
+
+
+def cached_getaddrinfo(host, port, *args, **kwargs):
+    """getaddrinfo with a TTL cache for upstream hosts; stale answers are kept if DNS fails."""
+    if host not in UPSTREAM_HOSTS:
+        return _system_getaddrinfo(host, port, *args, **kwargs)
+
+    key = (host, port, args, tuple(sorted(kwargs.items())))
+    with _dns_cache_lock:
+        entry = _dns_cache.get(key)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+
+    try:
+        result = _system_getaddrinfo(host, port, *args, **kwargs)
+    except socket.gaierror:
+        if entry:
+            return entry[1]
+        raise
+    with _dns_cache_lock:
+        _dns_cache[key] = (time.monotonic() + DNS_TTL, result)
+    return result
+
+
+socket.getaddrinfo = cached_getaddrinfo
+
+# host -> {"first_request_ms", "avg_ms", "requests"} for real upstream traffic
+host_latency = {}
+warmup_state = {"runs": 0, "last_run": None, "hosts": {}}
+
+
+def record_host_latency(host: str, elapsed_ms: float):
+    stats = host_latency.get(host)
+    if stats is None:
+        host_latency[host] = {"first_request_ms": round(elapsed_ms, 1), "avg_ms": round(elapsed_ms, 1), "requests": 1}
+        return
+    stats["requests"] += 1
+    stats["avg_ms"] = round(stats["avg_ms"] * 0.9 + elapsed_ms * 0.1, 1)
+
+
+def warm_host(host: str) -> dict:
+    """Resolve the host into the DNS cache and open pooled TLS connections to it."""
+    stats = {}
+    try:
+        started = time.monotonic()
+        socket.getaddrinfo(host, 443, allowed_gai_family(), socket.SOCK_STREAM)
+        stats["dns_ms"] = round((time.monotonic() - started) * 1000, 1)
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=WARMUP_CONNECTIONS) as pool:
+            list(pool.map(
+                lambda _: upstream_session.head(f"https://{host}/", timeout=5, allow_redirects=False).close(),
+                range(WARMUP_CONNECTIONS),
+            ))
+        stats["connect_ms"] = round((time.monotonic() - started) * 1000, 1)
+        stats["ok"] = True
+    except Exception as e:
+        stats["ok"] = False
+        stats["error"] = str(e)
+    return stats
+
+
+def warm_upstreams():
+    with ThreadPoolExecutor(max_workers=len(UPSTREAM_HOSTS)) as pool:
+        results = dict(zip(UPSTREAM_HOSTS, pool.map(warm_host, UPSTREAM_HOSTS)))
+    warmup_state["hosts"] = results
+    warmup_state["runs"] += 1
+    warmup_state["last_run"] = int(time.time())
+
+
+def warmup_loop(stop: threading.Event):
+    while not stop.is_set():
+        warm_upstreams()
+        stop.wait(WARMUP_INTERVAL)
+
+
+def warmup_report() -> dict:
+    return {
+        "enabled": WARMUP_ENABLED,
+        "runs": warmup_state["runs"],
+        "last_run": warmup_state["last_run"],
+        "hosts": {
+            host: {
+                **warmup_state["hosts"].get(host, {}),
+                **host_latency.get(host, {}),
+                "timeout": provider_timeouts(host),
+                "inflight": host_inflight.get(host, 0),
+                "calls_this_minute": calls_this_minute(host),
+                "weight": provider_weight(host),
+                "quota": provider_quota(host),
+                **(provider_throttles[host].report() if host in provider_throttles else {}),
+            }
+            for host in UPSTREAM_HOSTS
+        },
+    }
+
+
+warmup_stop = threading.Event()
+
+
+@app.on_event("startup")
+def start_warmup():
+    if WARMUP_ENABLED:
+        threading.Thread(target=warmup_loop, args=(warmup_stop,), name="upstream-warmup", daemon=True).start()
+
+
+@app.on_event("shutdown")
+def stop_warmup():
+    warmup_stop.set()
+
+
+# ------------------------------
+# Adaptive per-provider timeouts
+# ------------------------------
+
+TIMEOUT_WINDOW = int(os.getenv("TIMEOUT_WINDOW", "200"))           # samples kept per host
+TIMEOUT_MIN_SAMPLES = int(os.getenv("TIMEOUT_MIN_SAMPLES", "20"))   # below this: UPSTREAM_TIMEOUT
+TIMEOUT_FACTOR = float(os.getenv("TIMEOUT_FACTOR", "3"))            # timeout = p99 x factor
+CONNECT_TIMEOUT_BOUNDS = (float(os.getenv("CONNECT_TIMEOUT_MIN", "1")), float(os.getenv("CONNECT_TIMEOUT_MAX", "4")))
+READ_TIMEOUT_BOUNDS = (float(os.getenv("READ_TIMEOUT_MIN", "1.5")), float(os.getenv("READ_TIMEOUT_MAX", str(UPSTREAM_TIMEOUT))))
+
+# game -> overrides for "factor", "connect" (min, max) and "read" (min, max)
+TIMEOUT_OVERRIDES = {
+    "double_diamonds": {"read": (3, 15)},       # large products payload
+    "ml_role_brazil": {"read": (2, 10)},
+    "ml_role_brazil_wkp": {"read": (2, 10)},
+    "ml_role_php": {"read": (2, 10)},
+    "ml_role_ru": {"read": (2, 10)},
+}
+
+# host -> recent latencies (seconds); pooled connections hide the handshake,
+# so connect and read timeouts share one distribution with separate bounds
+latency_window = {}
+
+
+def record_provider_latency(host: str, elapsed_ms: float):
+    window = latency_window.get(host)
+    if window is None:
+        window = latency_window[host] = deque(maxlen=TIMEOUT_WINDOW)
+    window.append(elapsed_ms / 1000)
+
+
+def clamp(value: float, bounds) -> float:
+    low, high = bounds
+    return max(low, min(high, value))
+
+
+def total_timeout(timeout) -> float:
+    return sum(timeout) if isinstance(timeout, tuple) else timeout
+
+
+def provider_timeouts(host: str, game: str = None):
+    """(connect, read) timeout for a provider from p99 of its recent latency."""
+    override = TIMEOUT_OVERRIDES.get(game, {})
+    connect_bounds = override.get("connect", CONNECT_TIMEOUT_BOUNDS)
+    read_bounds = override.get("read", READ_TIMEOUT_BOUNDS)
+
+    window = latency_window.get(host)
+    if window is None or len(window) < TIMEOUT_MIN_SAMPLES:
+        return clamp(UPSTREAM_TIMEOUT, connect_bounds), clamp(UPSTREAM_TIMEOUT, read_bounds)
+
+    samples = sorted(window)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    budget = p99 * override.get("factor", TIMEOUT_FACTOR)
+    return round(clamp(budget, connect_bounds), 2), round(clamp(budget, read_bounds), 2)
+
+
+# ------------------------------
+# Lookup cache + game registry
+# ------------------------------
+
+LOOKUP_TTL = int(os.getenv("LOOKUP_TTL", "300"))                    # found IDs
+LOOKUP_NEGATIVE_TTL = int(os.getenv("LOOKUP_NEGATIVE_TTL", "60"))   # wrong IDs
+LOOKUP_CACHE_SIZE = int(os.getenv("LOOKUP_CACHE_SIZE", "50000"))
+
+
+class LookupCache:
+    """Bounded LRU cache of lookup responses with per-entry expiry."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def peek(self, key):
+        """(seconds left, value) for a live entry, or None."""
+        value = self.get(key)
+        if value is None:
+            return None
+        with self._lock:
+            entry = self._data.get(key)
+        return (entry[0] - time.monotonic(), value) if entry else None
+
+    def set(self, key, value, ttl: float):
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+# Lookup results in compact form (fixed slots + string arena)
+LOOKUP_CACHE_STORAGE = os.getenv("LOOKUP_CACHE_STORAGE", "compact")                 # "compact" or "dict"
+LOOKUP_CACHE_BYTES = int(os.getenv("LOOKUP_CACHE_BYTES", str(256 * 1024 * 1024)))    # records + interned strings
+
+# Low-cardinality, provider-chosen fields whose string values are interned rather
+# than stored per entry. Never caller input (zone, zoneid): interned strings are
+# never freed, so callers could fill the table.
+INTERNED_FIELDS = frozenset({"message", "region", "country", "server"})
+INTERNED_VALUES_MAX = 4096      # table size past which values are stored inline (names/games still interned)
+INTERNED_VALUE_LEN = 64         # longer values are always inline
+
+_U8, _U16, _U32, _I64, _F64 = (struct.Struct(fmt) for fmt in ("<B", "<H", "<I", "<q", "<d"))
+
+
+class StringTable:
+    """Append-only interned strings (field names, games, messages) addressed by 16-bit ids."""
+
+    MAX = 0xFFFF
+
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+        self.bytes = 0
+
+    def id(self, value: str, limit: int = None):
+        """Id of `value`, interning it while the table holds fewer than `limit` (default MAX) strings; else None."""
+        sid = self.ids.get(value)
+        if sid is None and len(self.strings) < min(limit or self.MAX, self.MAX):
+            sid = self.ids[value] = len(self.strings)
+            self.strings.append(value)
+            self.bytes += len(value.encode())
+        return sid
+
+
+class CompactLookupCache:
+    """
+    Lookup cache for millions of entries. Each entry is one record in a
+    bytearray arena (key + tagged binary encoding of the result, with
+    interned field names / messages and inline UTF-8 usernames), addressed
+    by an open-addressing table of fixed-size slots held in typed arrays:
+    hash (8 B), arena offset (4 B), record length (4 B), expiry (4 B,
+    seconds) and a CLOCK reference bit (1 B). Both an entry count and a
+    byte budget over the live record bytes plus the interned strings are
+    enforced exactly; freed records are reclaimed by compacting the arena
+    once garbage exceeds the live bytes.
+    """
+
+    EMPTY, DELETED = 0, 1
+    LOAD_FACTOR = 0.7
+
+    def __init__(self, maxsize: int, max_bytes: int):
+        self.maxsize = maxsize
+        self.max_bytes = min(max_bytes, 0x7FFFFFFF)     # offsets are 32-bit; garbage <= live
+        capacity = 8
+        while capacity * self.LOAD_FACTOR < maxsize:
+            capacity *= 2
+        self.capacity = capacity
+        self._mask = capacity - 1
+        self._hashes = array.array("q", bytes(8 * capacity))
+        self._offsets = array.array("I", bytes(4 * capacity))
+        self._lengths = array.array("I", bytes(4 * capacity))
+        self._expires = array.array("I", bytes(4 * capacity))
+        self._ref = bytearray(capacity)
+        self._arena = bytearray()
+        self._epoch = time.monotonic()
+        self._hand = 0
+        self.strings = StringTable()
+        self.count = 0
+        self.deleted = 0
+        self.live_bytes = 0
+        self.garbage_bytes = 0
+        self._lock = threading.Lock()
+
+    # -- encoding --
+
+    def _key_bytes(self, key):
+        """(game, id, zone) -> interned game id + "id\x1fzone" ("\x00" for no zone)."""
+        game, id, zone = key
+        game_id = self.strings.id(game)
+        if game_id is None:
+            return None
+        return _U16.pack(game_id) + f"{id}\x1f{chr(0) if zone is None else zone}".encode()
+
+    def _encode(self, value, out: bytearray, intern: bool = False):
+        if value is None:
+            out += b"N"
+        elif value is True:
+            out += b"T"
+        elif value is False:
+            out += b"F"
+        elif isinstance(value, int):
+            out += b"i"
+            out += _I64.pack(value)
+        elif isinstance(value, float):
+            out += b"d"
+            out += _F64.pack(value)
+        elif isinstance(value, str):
+            sid = (
+                self.strings.id(value, INTERNED_VALUES_MAX)
+                if intern and len(value) <= INTERNED_VALUE_LEN else None
+            )
+            if sid is not None:
+                out += b"x"
+                out += _U16.pack(sid)
+                return
+            raw = value.encode()
+            if len(raw) < 256:
+                out += b"z"
+                out += _U8.pack(len(raw))
+            else:
+                out += b"s"
+                out += _U32.pack(len(raw))
+            out += raw
+        elif isinstance(value, dict):
+            out += b"m"
+            out += _U32.pack(len(value))
+            for field, item in value.items():
+                field_id = self.strings.id(field) if isinstance(field, str) else None
+                if field_id is None:
+                    raise TypeError(f"unsupported key {field!r}")
+                out += _U16.pack(field_id)
+                self._encode(item, out, field in INTERNED_FIELDS)
+        elif isinstance(value, (list, tuple)):
+            out += b"l"
+            out += _U32.pack(len(value))
+            for item in value:
+                self._encode(item, out, intern)
+        else:
+            raise TypeError(f"unsupported value {type(value).__name__}")
+
+    def _decode(self, data, pos: int):
+        tag = data[pos]
+        pos += 1
+        if tag == 0x7A:         # z: short inline string
+            size = data[pos]
+            return str(data[pos + 1:pos + 1 + size], "utf-8"), pos + 1 + size
+        if tag == 0x78:         # x: interned string
+            return self.strings.strings[_U16.unpack_from(data, pos)[0]], pos + 2
+        if tag == 0x6D:         # m: dict
+            count, pos = _U32.unpack_from(data, pos)[0], pos + 4
+            result = {}
+            for _ in range(count):
+                field = self.strings.strings[_U16.unpack_from(data, pos)[0]]
+                result[field], pos = self._decode(data, pos + 2)
+            return result, pos
+        if tag == 0x69:         # i
+            return _I64.unpack_from(data, pos)[0], pos + 8
+        if tag == 0x54:         # T
+            return True, pos
+        if tag == 0x46:         # F
+            return False, pos
+        if tag == 0x4E:         # N
+            return None, pos
+        if tag == 0x73:         # s: long inline string
+            size = _U32.unpack_from(data, pos)[0]
+            return str(data[pos + 4:pos + 4 + size], "utf-8"), pos + 4 + size
+        if tag == 0x6C:         # l: list
+            count, pos = _U32.unpack_from(data, pos)[0], pos + 4
+            items = []
+            for _ in range(count):
+                item, pos = self._decode(data, pos)
+                items.append(item)
+            return items, pos
+        if tag == 0x64:         # d
+            return _F64.unpack_from(data, pos)[0], pos + 8
+        raise ValueError(f"corrupt cache record (tag {tag})")
+
+    # -- slots --
+
+    @staticmethod
+    def _hash(key_bytes: bytes) -> int:
+        h = hash(key_bytes)
+        return h if h > 1 or h < 0 else h + 2
+
+    def _find(self, key_bytes: bytes, h: int):
+        """(slot holding the key or -1, first reusable slot on the probe path)."""
+        hashes, arena = self._hashes, self._arena
+        i, free = h & self._mask, -1
+        while True:
+            stored = hashes[i]
+            if stored == self.EMPTY:
+                return -1, (i if free < 0 else free)
+            if stored == self.DELETED:
+                if free < 0:
+                    free = i
+            elif stored == h:
+                offset = self._offsets[i]
+                size = _U16.unpack_from(arena, offset)[0]
+                if arena[offset + 2:offset + 2 + size] == key_bytes:
+                    return i, free
+            i = (i + 1) & self._mask
+
+    def _remove(self, i: int):
+        self.live_bytes -= self._lengths[i]
+        self.garbage_bytes += self._lengths[i]
+        self._hashes[i] = self.DELETED
+        self.count -= 1
+        self.deleted += 1
+
+    def _evict_one(self):
+        """CLOCK: expired or unreferenced entries go first; referenced ones get a second chance."""
+        now = time.monotonic() - self._epoch
+        while True:
+            i = self._hand
+            self._hand = (i + 1) & self._mask
+            if self._hashes[i] not in (self.EMPTY, self.DELETED):
+                if self._expires[i] < now or not self._ref[i]:
+                    self._remove(i)
+                    return
+                self._ref[i] = 0
+
+    def _live_slots(self):
+        hashes = self._hashes
+        return [i for i in range(self.capacity) if hashes[i] not in (self.EMPTY, self.DELETED)]
+
+    def _rehash(self):
+        """Rebuild the slot table without tombstones."""
+        live = [
+            (self._hashes[i], self._offsets[i], self._lengths[i], self._expires[i], self._ref[i])
+            for i in self._live_slots()
+        ]
+        self._hashes = array.array("q", bytes(8 * self.capacity))
+        for h, offset, length, expires, ref in live:
+            i = h & self._mask
+            while self._hashes[i] != self.EMPTY:
+                i = (i + 1) & self._mask
+            self._hashes[i], self._offsets[i], self._lengths[i], self._expires[i], self._ref[i] = h, offset, length, expires, ref
+        self.deleted = 0
+
+    def _compact(self):
+        """Copy live records into a fresh arena, dropping freed ones."""
+        arena = bytearray()
+        for i in self._live_slots():
+            offset, length = self._offsets[i], self._lengths[i]
+            self._offsets[i] = len(arena)
+            arena += self._arena[offset:offset + length]
+        self._arena = arena
+        self.garbage_bytes = 0
+
+    # -- public API (same as LookupCache) --
+
+    def get(self, key):
+        entry = self.peek(key)
+        return entry[1] if entry else None
+
+    def peek(self, key):
+        """(seconds left, value) for a live entry, or None."""
+        with self._lock:
+            key_bytes = self._key_bytes(key)
+            if key_bytes is None:
+                return None
+            i, _ = self._find(key_bytes, self._hash(key_bytes))
+            if i < 0:
+                return None
+            left = self._expires[i] - (time.monotonic() - self._epoch)
+            if left <= 0:
+                self._remove(i)
+                return None
+            self._ref[i] = 1
+            return left, self._decode(self._arena, self._offsets[i] + 2 + len(key_bytes))[0]
+
+    def set(self, key, value, ttl: float):
+        if ttl <= 0:
+            return
+        with self._lock:
+            key_bytes = self._key_bytes(key)
+            if key_bytes is None or len(key_bytes) > 0xFFFF:
+                return
+            record = bytearray(_U16.pack(len(key_bytes)) + key_bytes)
+            try:
+                self._encode(value, record)
+            except (TypeError, struct.error):
+                return
+            if self.strings.bytes + len(record) > self.max_bytes:
+                return
+
+            h = self._hash(key_bytes)
+            i, _ = self._find(key_bytes, h)
+            if i >= 0:
+                self._remove(i)
+            while self.count and (
+                self.count >= self.maxsize or self.live_bytes + self.strings.bytes + len(record) > self.max_bytes
+            ):
+                self._evict_one()
+            if self.count + self.deleted + 1 > self.capacity * 0.85:
+                self._rehash()
+            if self.garbage_bytes > self.live_bytes and self.garbage_bytes > 1024 * 1024:
+                self._compact()
+
+            _, i = self._find(key_bytes, h)
+            if self._hashes[i] == self.DELETED:
+                self.deleted -= 1
+            self._hashes[i] = h
+            self._offsets[i] = len(self._arena)
+            self._lengths[i] = len(record)
+            self._expires[i] = math.ceil(time.monotonic() - self._epoch + ttl)
+            self._ref[i] = 1
+            self._arena += record
+            self.count += 1
+            self.live_bytes += len(record)
+
+    def memory_report(self) -> dict:
+        slot_bytes = self.capacity * (8 + 4 + 4 + 4 + 1)
+        return {
+            "entries": self.count,
+            "record_bytes": self.live_bytes,
+            "garbage_bytes": self.garbage_bytes,
+            "arena_bytes": len(self._arena),
+            "slot_bytes": slot_bytes,
+            "interned_strings": len(self.strings.strings),
+            "interned_bytes": self.strings.bytes,
+            "bytes_per_entry": round((len(self._arena) + slot_bytes) / self.count, 1) if self.count else None,
+            "max_bytes": self.max_bytes,
+        }
+
+
+# ------------------------------
+# Shared-memory cache (several workers on one host)
+# ------------------------------
+
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH")      # e.g. /dev/shm/ign-api; unset = per-worker state
+SHARED_CACHE_SLOTS = int(os.getenv("SHARED_CACHE_SLOTS", "262144"))
+SHARED_CACHE_SLOT_BYTES = int(os.getenv("SHARED_CACHE_SLOT_BYTES", "512"))
+SHARED_CACHE_STRIPES = int(os.getenv("SHARED_CACHE_STRIPES", "64"))
+
+_SHM_HEADER = struct.Struct("<8sIII")      # magic, slots, slot bytes, ways
+_SHM_SLOT = struct.Struct("<QdHH")         # key hash (0 = empty), expires (unix time), key length, value length
+
+
+class SharedMemoryTable:
+    """
+    Fixed-size hash table in an mmap'd file shared by every worker on the
+    host. Keys hash (blake2b, identical in every process) to a bucket of
+    `WAYS` slots; a full bucket evicts its soonest-expiring entry.
+
+    Buckets are guarded by lock stripes: a thread lock per stripe inside a
+    worker plus an fcntl byte-range lock across workers. The kernel drops
+    fcntl locks of a process that dies, and a slot's hash is written last
+    (after being cleared), so a worker killed mid-write leaves at worst an
+    empty slot and the others carry on. The file name includes the table
+    geometry, so workers only ever attach to a table laid out as they expect.
+    """
+
+    MAGIC = b"IGNSHM01"
+    WAYS = 8
+
+    def __init__(self, path: str, slots: int, slot_bytes: int, stripes: int):
+        self.buckets = max(1, -(-slots // self.WAYS))
+        self.slot_bytes = slot_bytes
+        self.capacity = slot_bytes - _SHM_SLOT.size
+        self.path = f"{path}.{self.buckets * self.WAYS}x{slot_bytes}"
+        size = _SHM_HEADER.size + self.buckets * self.WAYS * slot_bytes
+        header = _SHM_HEADER.pack(self.MAGIC, self.buckets * self.WAYS, slot_bytes, self.WAYS)
+
+        # POSIX-only; imported here so the app still loads where no shared cache is configured
+        import fcntl
+        import mmap
+        self._fcntl = fcntl
+
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            if os.fstat(self.fd).st_size != size or os.pread(self.fd, len(header), 0) != header:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, header, 0)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, 0)
+        self.mm = mmap.mmap(self.fd, size)
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    @staticmethod
+    def key_hash(key: bytes) -> int:
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") | 1
+
+    @contextlib.contextmanager
+    def _bucket_lock(self, bucket: int):
+        stripe = bucket % len(self._locks)
+        with self._locks[stripe]:
+            self._fcntl.lockf(self.fd, self._fcntl.LOCK_EX, 1, 1 + stripe)
+            try:
+                yield
+            finally:
+                self._fcntl.lockf(self.fd, self._fcntl.LOCK_UN, 1, 1 + stripe)
+
+    def _slot(self, bucket: int, way: int) -> int:
+        return _SHM_HEADER.size + (bucket * self.WAYS + way) * self.slot_bytes
+
+    def _find(self, bucket: int, h: int, key: bytes, now: float):
+        """(offset of the key's slot or None, offset to write a new entry to)."""
+        mm, victim, victim_expires = self.mm, None, None
+        for way in range(self.WAYS):
+            offset = self._slot(bucket, way)
+            stored, expires, key_len, _ = _SHM_SLOT.unpack_from(mm, offset)
+            start = offset + _SHM_SLOT.size
+            if stored == h and key_len == len(key) and mm[start:start + key_len] == key:
+                return offset, offset
+            if stored == 0 or expires < now:
+                expires = -1.0
+            if victim is None or expires < victim_expires:
+                victim, victim_expires = offset, expires
+        return None, victim
+
+    def _read(self, offset: int):
+        _, expires, key_len, value_len = _SHM_SLOT.unpack_from(self.mm, offset)
+        start = offset + _SHM_SLOT.size + key_len
+        return expires, self.mm[start:start + value_len]
+
+    def _write(self, offset: int, h: int, key: bytes, value: bytes, expires: float):
+        _SHM_SLOT.pack_into(self.mm, offset, 0, 0.0, 0, 0)
+        start = offset + _SHM_SLOT.size
+        self.mm[start:start + len(key) + len(value)] = key + value
+        _SHM_SLOT.pack_into(self.mm, offset, h, expires, len(key), len(value))
+
+    def get(self, key: bytes):
+        """(expires, value) of a live entry, or None."""
+        h = self.key_hash(key)
+        bucket = h % self.buckets
+        now = time.time()
+        with self._bucket_lock(bucket):
+            offset, _ = self._find(bucket, h, key, now)
+            if offset is None:
+                return None
+            expires, value = self._read(offset)
+            if expires < now:
+                _SHM_SLOT.pack_into(self.mm, offset, 0, 0.0, 0, 0)
+                return None
+            return expires, value
+
+    def set(self, key: bytes, value: bytes, expires: float) -> bool:
+        if len(key) + len(value) > self.capacity:
+            return False
+        h = self.key_hash(key)
+        bucket = h % self.buckets
+        with self._bucket_lock(bucket):
+            _, offset = self._find(bucket, h, key, time.time())
+            self._write(offset, h, key, value, expires)
+        return True
+
+    def update(self, key: bytes, fn):
+        """
+        Atomic read-modify-write: fn(current value or None) returns
+        (result, new value or None to leave the entry, expires).
+        """
+        h = self.key_hash(key)
+        bucket = h % self.buckets
+        now = time.time()
+        with self._bucket_lock(bucket):
+            offset, victim = self._find(bucket, h, key, now)
+            current = None
+            if offset is not None:
+                expires, current = self._read(offset)
+                current = bytes(current) if expires >= now else None
+            result, value, expires = fn(current)
+            if value is not None and len(key) + len(value) <= self.capacity:
+                self._write(offset if offset is not None else victim, h, key, value, expires)
+        return result
+
+
+class SharedLookupCache:
+    """LookupCache API over a SharedMemoryTable; results are stored as compact JSON (too big for a slot = not cached)."""
+
+    def __init__(self, table: SharedMemoryTable):
+        self.table = table
+
+    @staticmethod
+    def _key(key) -> bytes:
+        return json.dumps(key, separators=(",", ":")).encode()
+
+    def get(self, key):
+        entry = self.peek(key)
+        return entry[1] if entry else None
+
+    def peek(self, key):
+        """(seconds left, value) for a live entry, or None."""
+        entry = self.table.get(self._key(key))
+        if entry is None:
+            return None
+        expires, raw = entry
+        return expires - time.time(), json.loads(bytes(raw))
+
+    def set(self, key, value, ttl: float):
+        if ttl <= 0:
+            return
+        try:
+            raw = json.dumps(value, separators=(",", ":")).encode()
+        except (TypeError, ValueError):
+            return
+        self.table.set(self._key(key), raw, time.time() + ttl)
+
+
+shared_lookups = shared_limits = None
+if SHARED_CACHE_PATH:
+    shared_lookups = SharedMemoryTable(
+        f"{SHARED_CACHE_PATH}.lookups", SHARED_CACHE_SLOTS, SHARED_CACHE_SLOT_BYTES, SHARED_CACHE_STRIPES
+    )
+    shared_limits = SharedMemoryTable(f"{SHARED_CACHE_PATH}.limits", 65536, 128, SHARED_CACHE_STRIPES)
+
+
+if shared_lookups is not None:
+    LOOKUP_CACHE = SharedLookupCache(shared_lookups)
+elif LOOKUP_CACHE_STORAGE == "compact":
+    LOOKUP_CACHE = CompactLookupCache(LOOKUP_CACHE_SIZE, LOOKUP_CACHE_BYTES)
+else:
+    LOOKUP_CACHE = LookupCache(LOOKUP_CACHE_SIZE)
+
+# Raw provider responses (GET only: Smile.One POSTs are signed per call)
+UPSTREAM_CACHE_TTL = int(os.getenv("UPSTREAM_CACHE_TTL", "60"))
+UPSTREAM_CACHE = LookupCache(int(os.getenv("UPSTREAM_CACHE_SIZE", "10000")))
+
+_upstream_inflight = {}
+_upstream_inflight_lock = threading.Lock()
+
+# game slug -> cached lookup function (filled by @game_lookup)
+GAME_LOOKUPS = {}
+
+
+def lookup_outcome(result) -> str:
+    """Classify a handler response as found / not_found / error."""
+    if not isinstance(result, dict):
+        return "error"
+    if result.get("status") is True:
+        return "found"
+    if result.get("code") in (403, 404):
+        return "not_found"
+    return "error"
+
+
+def game_lookup(game: str, cache: bool = True):
+    """
+    Register a route handler as the lookup for `game` and serve
+    repeated (game, id, zone) lookups from LOOKUP_CACHE.
+    """
+    def decorator(func):
+        params = inspect.signature(func).parameters
+        default_zone = params["zone"].default if "zone" in params else None
+        if default_zone is inspect.Parameter.empty:
+            default_zone = None
+        rate_limited = rate_limiter is not None and game not in RATE_EXEMPT_GAMES
+        cost = GAME_COSTS.get(game, 1)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            record_handler_wait()
+            started = time.monotonic()
+            key = (game, str(kwargs.get("id")), kwargs.get("zone", default_zone))
+            result, cache_status = cached_lookup_result(key) if cache else (None, "miss")
+
+            # Only routed HTTP calls are charged here; /games/discover and /ws charge their own requests
+            request = kwargs.get("request")
+            if rate_limited and isinstance(request, Request):
+                charge = cost * CACHE_HIT_COST if cache_status in ("hit", "peer") else cost
+                retry_after = rate_limiter.acquire(kwargs.get("_") or request.client.host, charge)
+                if retry_after:
+                    if usage:
+                        usage.record(kwargs.get("_"), game, "rate_limited", False, 0, (time.monotonic() - started) * 1000)
+                    return rate_limited_response(game, request, retry_after)
+
+            verdict = None
+            attempts = None
+            if result is None and cache and negative_filter:
+                verdict = negative_filter.check(key)
+                if verdict == "reject":
+                    result, cache_status = format_response(False, "Wrong ID", {}, 404), "negative"
+
+            if result is None:
+                attempts = [0, 0, 0]
+                token = current_game.set(game)
+                attempts_token = current_attempts.set(attempts)
+                try:
+                    result = func(*args, **kwargs)
+                finally:
+                    current_game.reset(token)
+                    current_attempts.reset(attempts_token)
+                outcome = lookup_outcome(result)
+                gone = client_gone()
+                if gone:
+                    abandoned["requests"] += 1
+                # An abandoned chain's "not found" is not authoritative
+                if cache and (outcome == "found" or not gone):
+                    if outcome == "found":
+                        cache_lookup_result(key, result, LOOKUP_TTL)
+                        if verdict == "confirm":
+                            negative_filter.clear(key)
+                    # "Wrong ID or ... API unavailable" after timeouts / errors is retried, not cached
+                    elif outcome == "not_found" and all_attempts_answered(attempts):
+                        cache_lookup_result(key, result, LOOKUP_NEGATIVE_TTL)
+                        if negative_filter and verdict is None and is_authoritative_not_found(result, attempts):
+                            negative_filter.add(key)
+
+            if usage:
+                usage.record(
+                    kwargs.get("_"), game, lookup_outcome(result), cache_status != "miss",
+                    attempts[2] if attempts else 0, (time.monotonic() - started) * 1000,
+                )
+
+            # Served over HTTP -> attach client caching headers
+            if isinstance(request, Request):
+                return http_lookup_response(
+                    game, request, result, cache_status, attempts is None or all_attempts_answered(attempts),
+                )
+            return result
+
+        wrapper.game = game
+        wrapper.needs_zone = "zone" in params and default_zone is None
+        wrapper.accepts_zone = "zone" in params
+        wrapper.takes_request = "request" in params
+        GAME_LOOKUPS[game] = wrapper
+        return wrapper
+
+    return decorator
+
+
+def run_lookup(game: str, id: str, zone: str = None, api_key: str = None):
+    """Call a registered game lookup outside of its route (validation and cache included)."""
+    error = validate_lookup(game, id, zone)
+    if error:
+        return validation_error_response(game, *error)
+
+    lookup = GAME_LOOKUPS[game]
+    kwargs = {"id": id, "_": api_key}
+    if lookup.accepts_zone and zone is not None:
+        kwargs["zone"] = zone
+    if lookup.takes_request:
+        kwargs["request"] = None
+    return lookup(**kwargs)
+
+
+# ------------------------------
+# Rate limiting (GCRA, per API key)
+# ------------------------------
+
+RATE_LIMIT = os.getenv("RATE_LIMIT", "gcra")     # "gcra" or "off"
+
+# tier -> sustained lookups/second, burst size and daily quota (in cost units)
+RATE_TIERS = {
+    "test": {"per_second": 1, "burst": 5, "daily": 100},
+    "standard": {"per_second": 5, "burst": 20, "daily": 100},
+    "reseller": {"per_second": 50, "burst": 200, "daily": 100000},
+}
+DEFAULT_RATE_TIER = os.getenv("DEFAULT_RATE_TIER", "standard")
+
+# API key -> tier (unlisted keys get DEFAULT_RATE_TIER); extend with API_KEY_TIERS='{"key": "reseller"}'
+API_KEY_TIERS = {
+    "12345": "test",
+    "123456": "test",
+    **json.loads(os.getenv("API_KEY_TIERS", "{}")),
+}
+
+# game slug -> cost of one lookup (default 1); cache hits pay CACHE_HIT_COST of it
+GAME_COSTS = {
+    "mlbb_region": 2,
+    "discover": 4,      # one /games/discover call, which probes every zone-less game
+}
+
+# Lookups that are never rate limited (no limiter work at all)
+RATE_EXEMPT_GAMES = {"ml_role_brazil", "ml_role_brazil_wkp", "ml_role_php", "ml_role_ru", "double_diamonds"}
+CACHE_HIT_COST = float(os.getenv("CACHE_HIT_COST", "1"))
+
+
+class GcraLimiter:
+    """
+    Generic cell rate algorithm: per key, one theoretical arrival time (TAT)
+    for the per-second window and one for the daily quota. A lookup of cost
+    c is allowed when advancing the TAT by c emission intervals keeps it
+    within `burst` intervals of now; both windows must allow it. With a
+    shared `store` the TATs live in shared memory (wall clock) so every
+    worker on the host draws from the same allowance.
+    """
+
+    STATE = struct.Struct("<dd")
+
+    def __init__(self, tiers: dict, key_tiers: dict, default_tier: str, store: "SharedMemoryTable" = None):
+        for name, tier in tiers.items():
+            if tier["per_second"] <= 0 or tier["burst"] < 1 or tier["daily"] < 1:
+                raise ValueError(f"invalid rate tier {name!r}")
+        # tier -> ((emission interval, burst) per second, (interval, burst) per day)
+        self.windows = {
+            name: ((1 / tier["per_second"], tier["burst"]), (86400 / tier["daily"], tier["daily"]))
+            for name, tier in tiers.items()
+        }
+        self.key_tiers = key_tiers
+        self.default_tier = default_tier
+        self.store = store
+        self._tat = {}                  # key -> [second TAT, day TAT]
+        self._lock = threading.Lock()
+        self.stats = {"allowed": 0, "limited": 0}
+
+    def tier(self, key) -> str:
+        return self.key_tiers.get(key, self.default_tier)
+
+    @staticmethod
+    def _charge(tat, now: float, cost: float, windows):
+        """(seconds to wait, new second TAT, new day TAT) for charging `cost` at `now`."""
+        (second_interval, second_burst), (day_interval, day_burst) = windows
+        second_tat = max(tat[0], now) + cost * second_interval
+        day_tat = max(tat[1], now) + cost * day_interval
+        wait = max(second_tat - second_burst * second_interval, day_tat - day_burst * day_interval) - now
+        return wait, second_tat, day_tat
+
+    def acquire(self, key, cost: float = 1.0) -> float:
+        """Charge `cost` to `key`: 0 when allowed, else seconds until it would be."""
+        windows = self.windows[self.tier(key)]
+        if self.store is not None:
+            wait = self._acquire_shared(str(key), cost, windows)
+        else:
+            now = time.monotonic()
+            with self._lock:
+                tat = self._tat.get(key)
+                if tat is None:
+                    tat = self._tat[key] = [now, now]
+                wait, second_tat, day_tat = self._charge(tat, now, cost, windows)
+                if wait <= 0:
+                    tat[0], tat[1] = second_tat, day_tat
+
+        if wait > 0:
+            self.stats["limited"] += 1
+            return wait
+        self.stats["allowed"] += 1
+        return 0.0
+
+    def _acquire_shared(self, key: str, cost: float, windows) -> float:
+        now = time.time()
+
+        def charge(current):
+            tat = self.STATE.unpack(current) if current else (now, now)
+            wait, second_tat, day_tat = self._charge(tat, now, cost, windows)
+            if wait > 0:
+                return wait, None, 0
+            # the entry is only needed until both windows have refilled
+            return wait, self.STATE.pack(second_tat, day_tat), max(second_tat, day_tat)
+
+        return self.store.update(f"gcra:{key}".encode(), charge)
+
+
+rate_limiter = (
+    GcraLimiter(RATE_TIERS, API_KEY_TIERS, DEFAULT_RATE_TIER, store=shared_limits)
+    if RATE_LIMIT == "gcra" else None
+)
+
+
+def rate_limited_response(game: str, request: Request, retry_after: float) -> Response:
+    request.state.lookup = {"game": game, "cache": "limited", "outcome": "rate_limited"}
+    return negotiated_response(
+        request,
+        format_response(False, "Rate limit exceeded", {}, 429),
+        status_code=429,
+        headers={"Retry-After": str(math.ceil(retry_after))},
+    )
+
+
+# ------------------------------
+# Negative-ID filter (known-bad IDs)
+# ------------------------------
+
+NEGATIVE_FILTER = os.getenv("NEGATIVE_FILTER", "1") == "1"
+NEGATIVE_FILTER_CAPACITY = int(os.getenv("NEGATIVE_FILTER_CAPACITY", "200000"))   # IDs per generation per game
+NEGATIVE_FILTER_FP = float(os.getenv("NEGATIVE_FILTER_FP", "0.001"))
+NEGATIVE_FILTER_WINDOW = int(os.getenv("NEGATIVE_FILTER_WINDOW", "3600"))         # seconds per generation
+NEGATIVE_CONFIRM_RATE = float(os.getenv("NEGATIVE_CONFIRM_RATE", "1"))            # confirmations / s / game
+
+
+class RotatingBloomFilter:
+    """
+    Two-generation Bloom filter: inserts go to the current generation,
+    lookups check both, and every `window` seconds the older generation is
+    dropped. An entry therefore lives between one and two windows.
+    """
+
+    def __init__(self, capacity: int, fp_rate: float, window: int):
+        self.bits = max(8, int(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.window = window
+        self._current = bytearray((self.bits + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._rotated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def _maybe_rotate(self):
+        if time.monotonic() - self._rotated_at >= self.window:
+            with self._lock:
+                if time.monotonic() - self._rotated_at >= self.window:
+                    self._previous, self._current = self._current, bytearray(len(self._current))
+                    self._rotated_at = time.monotonic()
+
+    def add(self, item: str):
+        self._maybe_rotate()
+        bits = self._current
+        for pos in self._positions(item):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        self._maybe_rotate()
+        positions = self._positions(item)
+        return any(
+            all(bits[pos >> 3] & (1 << (pos & 7)) for pos in positions)
+            for bits in (self._current, self._previous)
+        )
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self._current) * 2
+
+
+class NegativeIdFilter:
+    """
+    Per-game rotating Bloom filters fed by authoritative not-found results.
+    A hit spends a per-game confirmation token to re-run the real lookup;
+    without a token it is answered as "Wrong ID" straight away. IDs that a
+    confirmation finds valid are cleared so false positives stop repeating.
+    """
+
+    def __init__(self, capacity: int, fp_rate: float, window: int, confirm_rate: float):
+        self.capacity, self.fp_rate, self.window = capacity, fp_rate, window
+        self.confirm_rate = confirm_rate
+        self.filters = {}
+        self.cleared = LookupCache(10000)
+        self.stats = {"added": 0, "hits": 0, "confirmed": 0, "rejected": 0, "cleared": 0}
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def _filter(self, game: str) -> RotatingBloomFilter:
+        bloom = self.filters.get(game)
+        if bloom is None:
+            with self._lock:
+                bloom = self.filters.setdefault(game, RotatingBloomFilter(self.capacity, self.fp_rate, self.window))
+        return bloom
+
+    def _take_token(self, game: str) -> bool:
+        now = time.monotonic()
+        burst = max(1.0, self.confirm_rate)
+        with self._lock:
+            tokens, last = self._tokens.get(game, (burst, now))
+            tokens = min(burst, tokens + (now - last) * self.confirm_rate)
+            allowed = tokens >= 1
+            self._tokens[game] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+    def check(self, key) -> str:
+        """None (not listed), "confirm" (run the lookup) or "reject"."""
+        game, item = key[0], f"{key[1]}|{key[2]}"
+        if item not in self._filter(game) or self.cleared.get(key):
+            return None
+        self.stats["hits"] += 1
+        if self._take_token(game):
+            self.stats["confirmed"] += 1
+            return "confirm"
+        self.stats["rejected"] += 1
+        return "reject"
+
+    def add(self, key):
+        self._filter(key[0]).add(f"{key[1]}|{key[2]}")
+        self.stats["added"] += 1
+
+    def clear(self, key):
+        self.cleared.set(key, True, self.window * 2)
+        self.stats["cleared"] += 1
+
+    def report(self) -> dict:
+        return {**self.stats, "games": len(self.filters), "bytes": sum(f.size_bytes for f in self.filters.values())}
+
+
+negative_filter = (
+    NegativeIdFilter(NEGATIVE_FILTER_CAPACITY, NEGATIVE_FILTER_FP, NEGATIVE_FILTER_WINDOW, NEGATIVE_CONFIRM_RATE)
+    if NEGATIVE_FILTER else None
+)
+
+# [answered, failed, sent] upstream attempts of the lookup running in this context.
+# Cache hits, joined fetches and fast-fails count as attempts but only real
+# provider calls count as sent (that is what usage reports).
+current_attempts = contextvars.ContextVar("current_attempts", default=None)
+
+
+def is_answer(status) -> bool:
+    """A provider status that counts as a real answer (not a 5xx or 429)."""
+    return status is not None and status < 500 and status != 429
+
+
+def count_send():
+    attempts = current_attempts.get()
+    if attempts is not None:
+        attempts[2] += 1
+
+
+def count_attempt(answered: bool):
+    attempts = current_attempts.get()
+    if attempts is not None:
+        attempts[0 if answered else 1] += 1
+
+
+def all_attempts_answered(attempts) -> bool:
+    """Every upstream attempt got a real (non-5xx/429) answer: no timeouts, errors or throttling."""
+    return attempts is not None and attempts[0] > 0 and attempts[1] == 0
+
+
+def is_authoritative_not_found(result, attempts) -> bool:
+    """404 where every upstream attempt got a real answer."""
+    return result.get("code") == 404 and all_attempts_answered(attempts)
+
+
+# ------------------------------
+# Cluster mode: lookup cache sharded across nodes
+# ------------------------------
+
+# Comma-separated base URLs of every node, this one included; unset = single node
+CLUSTER_NODES = [node.strip().rstrip("/") for node in os.getenv("CLUSTER_NODES", "").split(",") if node.strip()]
+CLUSTER_SELF = os.getenv("CLUSTER_SELF", "").rstrip("/")
+CLUSTER_SECRET = os.getenv("CLUSTER_SECRET")
+CLUSTER_VNODES = int(os.getenv("CLUSTER_VNODES", "128"))       # ring points per node
+CLUSTER_REPLICAS = int(os.getenv("CLUSTER_REPLICAS", "2"))     # owners per key
+CLUSTER_TIMEOUT = float(os.getenv("CLUSTER_TIMEOUT", "0.3"))   # seconds per peer call
+CLUSTER_NEAR_TTL = int(os.getenv("CLUSTER_NEAR_TTL", "5"))     # local copy of keys owned elsewhere
+CLUSTER_DOWN_TIME = int(os.getenv("CLUSTER_DOWN_TIME", "10"))  # skip a failed peer this long
+
+
+def ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent-hash ring with virtual nodes."""
+
+    def __init__(self, nodes, vnodes: int):
+        self.nodes = list(dict.fromkeys(nodes))
+        points = sorted((ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owners(self, key: str, count: int) -> list:
+        """The first `count` distinct nodes clockwise from the key's position."""
+        if not self._hashes:
+            return []
+        count = min(count, len(self.nodes))
+        owners = []
+        start = bisect.bisect(self._hashes, ring_hash(key))
+        for i in range(len(self._nodes)):
+            node = self._nodes[(start + i) % len(self._nodes)]
+            if node not in owners:
+                owners.append(node)
+                if len(owners) == count:
+                    break
+        return owners
+
+
+class CacheCluster:
+    """
+    Shares LOOKUP_CACHE across nodes. Every (game, id, zone) has
+    `replicas` owner nodes on the ring; a miss on a non-owner asks the
+    owners before calling a provider, and fresh results are written to
+    the owners in the background.
+    """
+
+    def __init__(self, nodes, self_url: str, secret: str, vnodes: int, replicas: int):
+        self.self_url = self_url
+        self.secret = secret
+        self.replicas = replicas
+        self.ring = HashRing(nodes, vnodes)
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=len(nodes), pool_maxsize=32))
+        self.session.mount("https://", HTTPAdapter(pool_connections=len(nodes), pool_maxsize=32))
+        self.pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cluster")
+        self.down_until = {}
+        self.stats = {"peer_hits": 0, "peer_misses": 0, "peer_errors": 0, "replicated": 0}
+
+    @staticmethod
+    def key_string(key) -> str:
+        return json.dumps(key)
+
+    def owners(self, key) -> list:
+        return self.ring.owners(self.key_string(key), self.replicas)
+
+    def owns(self, key) -> bool:
+        return self.self_url in self.owners(key)
+
+    def _peers(self, key) -> list:
+        now = time.monotonic()
+        return [node for node in self.owners(key) if node != self.self_url and self.down_until.get(node, 0) <= now]
+
+    def _call(self, method: str, node: str, **kwargs):
+        try:
+            response = self.session.request(
+                method, f"{node}/internal/cache", headers={"X-Cluster-Key": self.secret},
+                timeout=CLUSTER_TIMEOUT, **kwargs,
+            )
+        except requests.exceptions.RequestException:
+            self.down_until[node] = time.monotonic() + CLUSTER_DOWN_TIME
+            self.stats["peer_errors"] += 1
+            return None
+        self.down_until.pop(node, None)
+        return response
+
+    def get(self, key):
+        """Ask the key's owners in ring order; returns (value, ttl) or None."""
+        for node in self._peers(key):
+            response = self._call("GET", node, params={"key": self.key_string(key)})
+            if response is None:
+                continue
+            if response.status_code == 200:
+                self.stats["peer_hits"] += 1
+                entry = response.json()
+                return entry["value"], entry["ttl"]
+            if response.status_code == 404:
+                self.stats["peer_misses"] += 1
+                return None
+        return None
+
+    def set(self, key, value, ttl: float):
+        """Replicate a result to the other owners without waiting for them."""
+        payload = {"key": self.key_string(key), "value": value, "ttl": ttl}
+        for node in self._peers(key):
+            self.pool.submit(self._call, "PUT", node, json=payload)
+            self.stats["replicated"] += 1
+
+    def report(self) -> dict:
+        now = time.monotonic()
+        return {
+            "self": self.self_url,
+            "nodes": self.ring.nodes,
+            "down": [node for node, until in self.down_until.items() if until > now],
+            "replicas": self.replicas,
+            **self.stats,
+        }
+
+
+cluster = (
+    CacheCluster(CLUSTER_NODES, CLUSTER_SELF, CLUSTER_SECRET, CLUSTER_VNODES, CLUSTER_REPLICAS)
+    if CLUSTER_NODES and CLUSTER_SELF and CLUSTER_SECRET else None
+)
+
+
+def cache_lookup_result(key, result, ttl: float):
+    """Store a fresh result locally (briefly, unless this node owns the key) and on its owners."""
+    if cluster is None:
+        LOOKUP_CACHE.set(key, result, ttl)
+        return
+    LOOKUP_CACHE.set(key, result, ttl if cluster.owns(key) else min(ttl, CLUSTER_NEAR_TTL))
+    cluster.set(key, result, ttl)
+
+
+def cached_lookup_result(key):
+    """LOOKUP_CACHE, then the key's owner nodes; returns (result, cache_status)."""
+    result = LOOKUP_CACHE.get(key)
+    if result is not None:
+        return result, "hit"
+    if cluster is not None and not cluster.owns(key):
+        entry = cluster.get(key)
+        if entry is not None:
+            result, ttl = entry
+            LOOKUP_CACHE.set(key, result, min(ttl, CLUSTER_NEAR_TTL))
+            return result, "peer"
+    return None, "miss"
+
+
+def verify_cluster_key(request: Request):
+    cluster_key = request.headers.get("x-cluster-key")
+    if cluster is None or not hmac.compare_digest(cluster_key or "", cluster.secret):
+        raise HTTPException(status_code=401, detail="Invalid cluster key")
+    return cluster_key
+
+
+def parse_cluster_key(raw: str):
+    try:
+        game, id, zone = json.loads(raw)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cache key")
+    return game, str(id), zone
+
+
+if cluster is not None:
+    @app.get("/internal/cache")
+    def internal_cache_get(key: str, _: str = Depends(verify_cluster_key)):
+        """
+        Cluster peer read of a lookup cache entry.
+        """
+        entry = LOOKUP_CACHE.peek(parse_cluster_key(key))
+        if entry is None:
+            return JSONResponse(status_code=404, content={"value": None, "ttl": 0})
+        ttl, value = entry
+        return {"value": value, "ttl": ttl}
+
+    @app.put("/internal/cache")
+    def internal_cache_set(payload: dict = Body(...), _: str = Depends(verify_cluster_key)):
+        """
+        Cluster peer write of a lookup cache entry.
+        """
+        key = parse_cluster_key(payload.get("key"))
+        LOOKUP_CACHE.set(key, payload.get("value"), min(float(payload.get("ttl") or 0), LOOKUP_TTL))
+        return {"stored": True}
+
+    @app.get("/admin/cluster")
+    def cluster_status(_: str = Depends(verify_admin_key)):
+        """
+        Show the cache cluster ring and peer statistics.
+        """
+        return format_response(True, f"{len(cluster.ring.nodes)} node(s)", cluster.report())
+
+
+# ------------------------------
+# Provider affinity (which provider resolved an account last)
+# ------------------------------
+
+AFFINITY_ENABLED = os.getenv("AFFINITY", "1") == "1"
+AFFINITY_TTL = int(os.getenv("AFFINITY_TTL", str(7 * 24 * 3600)))
+PROVIDER_AFFINITY = LookupCache(int(os.getenv("AFFINITY_SIZE", "50000")))
+
+
+def provider_affinity(game: str, id: str, zone: str):
+    """(host, api zone) that last resolved this account, or None."""
+    if not AFFINITY_ENABLED:
+        return None
+    return PROVIDER_AFFINITY.get((game, str(id), zone.lower()))
+
+
+def remember_provider(game: str, id: str, zone: str, url: str, zone_api: str = None):
+    if AFFINITY_ENABLED:
+        PROVIDER_AFFINITY.set((game, str(id), zone.lower()), (urlsplit(url).netloc, zone_api), AFFINITY_TTL)
+
+
+def prefer_provider(urls: list, affinity) -> list:
+    """Move the remembered provider to the front; the rest keep their (balanced) order."""
+    if not affinity:
+        return urls
+    host = affinity[0]
+    return [url for url in urls if urlsplit(url).netloc == host] + [url for url in urls if urlsplit(url).netloc != host]
+
+
+def prefer_zone(zone_ids, affinity) -> list:
+    if not affinity or affinity[1] not in zone_ids:
+        return list(zone_ids)
+    return [affinity[1]] + [zone_id for zone_id in zone_ids if zone_id != affinity[1]]
+
+
+# ------------------------------
+# Binary response formats (Accept negotiation)
+# ------------------------------
+
+try:
+    import msgpack
+except ImportError:     # optional: pip install msgpack
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:     # optional: pip install cbor2
+    cbor2 = None
+
+# media type -> encoder; JSON is always available and stays the default
+BINARY_ENCODERS = {}
+if msgpack is not None:
+    BINARY_ENCODERS["application/msgpack"] = functools.partial(msgpack.packb, use_bin_type=True, default=str)
+if cbor2 is not None:
+    BINARY_ENCODERS["application/cbor"] = cbor2.dumps
+
+MEDIA_TYPE_ALIASES = {"application/x-msgpack": "application/msgpack"}
+
+
+@functools.lru_cache(maxsize=256)
+def negotiate_media_type(accept: str):
+    """
+    Binary media type to answer with, or None for JSON. A binary type wins
+    only when listed explicitly with a higher q than application/json;
+    wildcards never select a binary format.
+    """
+    json_q, best, best_q = 0.0, None, 0.0
+    for item in accept.split(","):
+        media, *params = [part.strip() for part in item.split(";")]
+        media = MEDIA_TYPE_ALIASES.get(media.lower(), media.lower())
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if media == "application/json":
+            json_q = max(json_q, q)
+        elif media in BINARY_ENCODERS and q > best_q:
+            best, best_q = media, q
+    return best if best_q > json_q else None
+
+
+def request_media_type(request: Request):
+    if not BINARY_ENCODERS:
+        return None
+    return negotiate_media_type(request.headers.get("accept", ""))
+
+
+def negotiated_response(request: Request, content, status_code: int = 200, headers: dict = None,
+                        media_type: str = None) -> Response:
+    """JSONResponse, or the same payload as msgpack / CBOR when the client asks for it."""
+    media_type = media_type or request_media_type(request)
+    if BINARY_ENCODERS:
+        headers = {"Vary": "Accept", **(headers or {})}
+    if media_type is None:
+        return JSONResponse(content=content, status_code=status_code, headers=headers)
+    return Response(BINARY_ENCODERS[media_type](content), status_code=status_code, headers=headers, media_type=media_type)
+
+
+# ------------------------------
+# Client caching headers (Cache-Control / ETag)
+# ------------------------------
+
+# Lookup responses are cacheable by the client only (`private`). A shared
+# cache such as the Vercel edge would answer anyone holding a key from any IP
+# without running verify_api_key, so it is never told to store them.
+CLIENT_CACHE_FOUND_TTL = (
+    int(os.getenv("CLIENT_CACHE_FOUND_MAXAGE", "60")), int(os.getenv("CLIENT_CACHE_FOUND_SWR", "300"))
+)
+CLIENT_CACHE_NOT_FOUND_TTL = (
+    int(os.getenv("CLIENT_CACHE_NOT_FOUND_MAXAGE", "15")), int(os.getenv("CLIENT_CACHE_NOT_FOUND_SWR", "60"))
+)
+
+# game -> {"found": (max-age, stale-while-revalidate), "not_found": ...}; None = no-store
+CLIENT_CACHE_RULES = {
+    "ml_role_brazil_wkp": {"found": None, "not_found": None},
+    "double_diamonds": {"found": (30, 60), "not_found": CLIENT_CACHE_NOT_FOUND_TTL},
+}
+CLIENT_CACHE_DEFAULT = {"found": CLIENT_CACHE_FOUND_TTL, "not_found": CLIENT_CACHE_NOT_FOUND_TTL}
+
+LOOKUP_VARY = "Accept, Accept-Encoding"
+
+
+def client_cache_control(game: str, outcome: str) -> str:
+    ttl = CLIENT_CACHE_RULES.get(game, CLIENT_CACHE_DEFAULT).get(outcome)
+    if not ttl:
+        return "no-store"
+    max_age, swr = ttl
+    return f"private, max-age={max_age}, stale-while-revalidate={swr}"
+
+
+def payload_etag(result, media_type: str = None) -> str:
+    """Strong ETag over the normalised (key-sorted) JSON payload, distinct per encoding."""
+    body = json.dumps(result, sort_keys=True, separators=(",", ":"), default=str)
+    digest = hashlib.blake2b(body.encode(), digest_size=16).hexdigest()
+    if media_type:
+        digest += "-" + media_type.rsplit("/", 1)[-1]
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def http_lookup_response(game: str, request: Request, result, cache_status: str, answered: bool = True) -> Response:
+    """
+    Wrap a lookup result with Cache-Control / ETag / Vary, answering 304 when
+    unchanged. A not-found that some provider failed to answer is a failure
+    ("... API unavailable") and goes out as no-store.
+    """
+    outcome = lookup_outcome(result)
+    request.state.lookup = {"game": game, "cache": cache_status, "outcome": outcome}
+    cache_control = client_cache_control(game, outcome if answered or outcome != "not_found" else "error")
+    headers = {"Cache-Control": cache_control, "Vary": LOOKUP_VARY, "X-Lookup-Cache": cache_status}
+    media_type = request_media_type(request)
+
+    if cache_control != "no-store":
+        etag = payload_etag(result, media_type)
+        headers["ETag"] = etag
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+
+    if media_type is None:
+        return JSONResponse(content=result, headers=headers)
+    return Response(BINARY_ENCODERS[media_type](result), headers=headers, media_type=media_type)
+
+
+# ------------------------------
+# Routing configuration (hot-reloadable)
+# ------------------------------
+
+ROUTING_CONFIG = os.getenv("ROUTING_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "routing.json"))
+ROUTING_POLL_INTERVAL = int(os.getenv("ROUTING_POLL_INTERVAL", "5"))
+URL_FIELDS = {"id", "zone", "alt_zone"}
+
+# What the handlers read from the routing config; a reload has to keep all of it.
+# Games under "smile_one" / "zones" must be present; each "providers" game may
+# only use the placeholders its handler fills in.
+ROUTING_SMILE_ONE_GAMES = {"ml_role_brazil", "ml_role_brazil_wkp", "ml_role_php", "ml_role_ru"}
+ROUTING_ZONE_GAMES = {"genshin_impact", "honkai_star_rail", "zenless_zone_zero", "wuthering_waves"}
+ROUTING_PROVIDER_FIELDS = {
+    **dict.fromkeys(
+        ("mlbb_region", "ml_ign", "ml_indo_id", "mobile_legends_adventure", "magic_chess_go_go", "double_diamonds",
+         "genshin_impact", "honkai_star_rail", "wuthering_waves"),
+        {"id", "zone"},
+    ),
+    **dict.fromkeys(
+        ("bgmi", "pubg_mobile_global", "honor_of_kings", "8_ball_pool", "blood_strike", "honkai_impact_3",
+         "super_sus", "arena_of_valor", "undawn", "sausage_man", "clash_of_clan", "clash_royale"),
+        {"id"},
+    ),
+    "zenless_zone_zero": {"id", "zone", "alt_zone"},
+}
+
+
+def freeze(value):
+    """Deep read-only copy: dicts -> MappingProxyType, lists -> tuples."""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def compile_routing(raw: dict):
+    """Validate a routing config and compile it into immutable lookup tables."""
+    if not isinstance(raw, dict):
+        raise ValueError("routing config must be a JSON object")
+    for section in ("smile_one", "providers", "zones"):
+        if not isinstance(raw.get(section), dict):
+            raise ValueError(f"routing config needs a '{section}' object")
+
+    for section, games in (
+        ("smile_one", ROUTING_SMILE_ONE_GAMES), ("providers", ROUTING_PROVIDER_FIELDS), ("zones", ROUTING_ZONE_GAMES),
+    ):
+        missing = sorted(set(games) - set(raw[section]))
+        if missing:
+            raise ValueError(f"routing config '{section}' is missing {missing}")
+
+    for game, product in raw["smile_one"].items():
+        if not isinstance(product, dict) or {"url", "product", "productid"} - set(product):
+            raise ValueError(f"smile_one.{game} needs 'url', 'product' and 'productid'")
+
+    for game, templates in raw["providers"].items():
+        if not isinstance(templates, list) or not templates or not all(
+            isinstance(t, str) and t.startswith("https://") for t in templates
+        ):
+            raise ValueError(f"providers.{game} must be a non-empty list of https:// URL templates")
+        allowed = ROUTING_PROVIDER_FIELDS.get(game, URL_FIELDS)
+        for template in templates:
+            try:
+                fields = {field for _, field, _, _ in string.Formatter().parse(template) if field is not None}
+            except ValueError as e:
+                raise ValueError(f"providers.{game}: bad template {template!r} ({e})")
+            if fields - allowed:
+                raise ValueError(f"providers.{game}: placeholder(s) {sorted(fields - allowed)} not supplied for this game")
+
+    balancing = raw.get("balancing", {})
+    for section in ("weights", "quotas"):
+        if not isinstance(balancing, dict) or not isinstance(balancing.get(section, {}), dict):
+            raise ValueError(f"balancing.{section} must be an object of host -> number")
+        for host, value in balancing.get(section, {}).items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError(f"balancing.{section}.{host} must be a positive number")
+
+    for game, zones in raw["zones"].items():
+        if not isinstance(zones, dict) or not isinstance(zones.get("aliases"), dict) or not isinstance(zones.get("names"), dict):
+            raise ValueError(f"zones.{game} needs 'aliases' and 'names' objects")
+        for alias, zone_ids in zones["aliases"].items():
+            if not isinstance(zone_ids, list):
+                raise ValueError(f"zones.{game}.aliases.{alias} must be a list of zone ids")
+            unknown = [zone_id for zone_id in zone_ids if zone_id not in zones["names"]]
+            if not zone_ids or unknown:
+                raise ValueError(f"zones.{game}.aliases.{alias} has no display name for {unknown or 'empty list'}")
+
+    return freeze({
+        **raw,
+        "balancing": {"weights": balancing.get("weights", {}), "quotas": balancing.get("quotas", {})},
+        "zones": {
+            game: {**zones, "aliases": {alias.lower(): ids for alias, ids in zones["aliases"].items()}}
+            for game, zones in raw["zones"].items()
+        },
     })
+
+
+def load_routing(path: str):
+    with open(path, encoding="utf-8") as f:
+        return compile_routing(json.load(f))
+
+
+def routing_hosts(routing) -> list:
+    urls = [product["url"] for product in routing["smile_one"].values()]
+    urls += [template for templates in routing["providers"].values() for template in templates]
+    return sorted({urlsplit(url).netloc for url in urls})
+
+
+ROUTING = load_routing(ROUTING_CONFIG)
+routing_state = {"path": ROUTING_CONFIG, "mtime": os.path.getmtime(ROUTING_CONFIG), "loaded_at": int(time.time()), "reloads": 0, "last_error": None}
+_routing_reload_lock = threading.Lock()
+
+
+def provider_urls(game: str, routing=None, **params) -> list:
+    """Fallback URLs for a game from a routing snapshot (current one by default)."""
+    routing = routing or ROUTING
+    return [template.format(**params) for template in routing["providers"][game]]
+
+
+def reload_routing() -> bool:
+    """
+    Re-read the routing file and swap it in with one assignment. Requests
+    already running keep the snapshot they started with; a bad file is
+    rejected and the current routing stays active.
+    """
+    global ROUTING, COMPILED_ID_RULES
+    with _routing_reload_lock:
+        try:
+            mtime = os.path.getmtime(ROUTING_CONFIG)
+            routing = load_routing(ROUTING_CONFIG)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            routing_state["last_error"] = str(e)
+            return False
+
+        ROUTING = routing
+        COMPILED_ID_RULES = compile_id_rules(ID_RULES, routing)
+        UPSTREAM_HOSTS[:] = sorted(set(UPSTREAM_HOSTS) | set(routing_hosts(routing)))
+        routing_state.update(mtime=mtime, loaded_at=int(time.time()), last_error=None)
+        routing_state["reloads"] += 1
+        return True
+
+
+def routing_watch_loop(stop: threading.Event):
+    while not stop.wait(ROUTING_POLL_INTERVAL):
+        try:
+            changed = os.path.getmtime(ROUTING_CONFIG) != routing_state["mtime"]
+        except OSError:
+            continue
+        if changed:
+            reload_routing()
+
+
+routing_watch_stop = threading.Event()
+
+
+@app.on_event("startup")
+def start_routing_watch():
+    if ROUTING_POLL_INTERVAL > 0:
+        threading.Thread(target=routing_watch_loop, args=(routing_watch_stop,), name="routing-watch", daemon=True).start()
+    try:
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=reload_routing, daemon=True).start())
+    except (AttributeError, ValueError):
+        pass    # no SIGHUP on this platform / not the main thread
+
+
+@app.on_event("shutdown")
+def stop_routing_watch():
+    routing_watch_stop.set()
+
+
+@app.get("/admin/routing")
+def routing_status(_: str = Depends(verify_admin_key)):
+    """
+    Show the active routing configuration and reload status.
+    """
+    return format_response(True, "Routing configuration", {**routing_state, "routing": json.loads(json.dumps(ROUTING, default=dict))})
+
+
+@app.post("/admin/routing/reload")
+def routing_reload(_: str = Depends(verify_admin_key)):
+    """
+    Reload the routing configuration file now.
+    """
+    if not reload_routing():
+        return JSONResponse(status_code=400, content=format_response(False, f"Reload failed: {routing_state['last_error']}", routing_state, 400))
+    return format_response(True, "Routing configuration reloaded", routing_state)
+
+
+# ------------------------------
+# Local ID / zone validation
+# ------------------------------
+
+MLBB_ID_RULE = {"id": (r"\d+", 5, 12), "zone_range": (1, 99999)}
+SUPERCELL_TAG_RULE = {"id": (r"[0289PYLQGRJCUV]+", 3, 12, re.IGNORECASE)}
+
+# game -> id (regex, min length, max length[, flags]) and numeric zone range
+ID_RULES = {
+    "mlbb_region": MLBB_ID_RULE,
+    "ml_role_brazil": MLBB_ID_RULE,
+    "ml_role_brazil_wkp": MLBB_ID_RULE,
+    "ml_role_php": MLBB_ID_RULE,
+    "ml_role_ru": MLBB_ID_RULE,
+    "ml_ign": MLBB_ID_RULE,
+    "ml_indo_id": MLBB_ID_RULE,
+    "mobile_legends_adventure": MLBB_ID_RULE,
+    "magic_chess_go_go": MLBB_ID_RULE,
+    "double_diamonds": MLBB_ID_RULE,
+    "bgmi": {"id": (r"\d+", 5, 15)},
+    "pubg_mobile_global": {"id": (r"\d+", 5, 15)},
+    "honor_of_kings": {"id": (r"\d+", 5, 20)},
+    "8_ball_pool": {"id": (r"\d[\d-]*", 6, 20)},
+    "blood_strike": {"id": (r"\d+", 5, 15)},
+    "honkai_impact_3": {"id": (r"\d+", 5, 12)},
+    "super_sus": {"id": (r"\d+", 4, 15)},
+    "arena_of_valor": {"id": (r"\d+", 5, 20)},
+    "undawn": {"id": (r"\d+", 5, 20)},
+    "sausage_man": {"id": (r"[A-Za-z0-9]+", 3, 20)},
+    "clash_of_clan": SUPERCELL_TAG_RULE,
+    "clash_royale": SUPERCELL_TAG_RULE,
+    # zone aliases for these come from the routing config
+    "genshin_impact": {"id": (r"\d+", 9, 10)},
+    "honkai_star_rail": {"id": (r"\d+", 9, 10)},
+    "zenless_zone_zero": {"id": (r"\d+", 8, 10)},
+    "wuthering_waves": {"id": (r"\d+", 6, 10)},
+}
+
+
+def compile_id_rules(rules: dict, routing) -> dict:
+    """
+    Precompile ID_RULES into regexes (ASCII only: `\\d` must not match other
+    scripts' digits), taking allowed zone aliases from the routing config.
+    """
+    compiled = {}
+    for game, rule in rules.items():
+        pattern, min_len, max_len, *flags = rule["id"]
+        zones = routing["zones"].get(game)
+        compiled[game] = {
+            "id_pattern": re.compile(pattern, re.ASCII | (flags[0] if flags else 0)),
+            "id_length": (min_len, max_len),
+            "zone_range": rule.get("zone_range"),
+            "zone_aliases": frozenset(zones["aliases"]) if zones else None,
+        }
+    return compiled
+
+
+COMPILED_ID_RULES = compile_id_rules(ID_RULES, ROUTING)
+
+
+def validate_lookup(game: str, id: str = None, zone: str = None):
+    """
+    Check id/zone against the game's rules without any network work.
+    Returns None when valid, else (field, rule, message).
+    """
+    rule = COMPILED_ID_RULES.get(game)
+    if rule is None:
+        return None
+
+    if id is not None:
+        min_len, max_len = rule["id_length"]
+        if not min_len <= len(id) <= max_len:
+            return "id", "id_length", f"ID must be {min_len}-{max_len} characters"
+        if not rule["id_pattern"].fullmatch(id):
+            return "id", "id_format", "ID contains invalid characters"
+
+    if zone is not None:
+        if rule["zone_range"]:
+            low, high = rule["zone_range"]
+            if not (zone.isascii() and zone.isdigit()):
+                return "zone", "zone_format", "Zone must be numeric"
+            if not low <= int(zone) <= high:
+                return "zone", "zone_range", f"Zone must be between {low} and {high}"
+        elif rule["zone_aliases"] is not None and zone.lower() not in rule["zone_aliases"]:
+            return "zone", "zone_alias", f"Zone must be one of {sorted(rule['zone_aliases'])}"
+
+    return None
+
+
+def validation_error_response(game: str, field: str, rule: str, message: str):
+    return format_response(False, f"Invalid {field} for {game}: {message}", {"field": field, "rule": rule}, 400)
+
+
+# path -> game, built from the registered routes on first use
+LOOKUP_PATHS = {}
+
+
+def lookup_game_for_path(path: str):
+    if not LOOKUP_PATHS:
+        for route in app.routes:
+            game = getattr(getattr(route, "endpoint", None), "game", None)
+            if game:
+                LOOKUP_PATHS[route.path] = game
+    return LOOKUP_PATHS.get(path)
+
+
+class ValidateLookupMiddleware:
+    """Reject malformed IDs before auth, rate limiting or any upstream call; pure ASGI."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        game = lookup_game_for_path(scope["path"]) if scope["type"] == "http" else None
+        if game:
+            request = Request(scope)
+            error = validate_lookup(game, request.query_params.get("id"), request.query_params.get("zone"))
+            if error:
+                response = negotiated_response(request, validation_error_response(game, *error), status_code=400)
+                return await response(scope, receive, send)
+        await self.app(scope, receive, send)
+
+
+app.add_middleware(ValidateLookupMiddleware)
+
+
+# ------------------------------
+# Structured access / upstream logging
+# ------------------------------
+
+ACCESS_LOG_PATH = os.getenv("ACCESS_LOG_PATH")            # unset = logging off
+ACCESS_LOG_MAX_BYTES = int(os.getenv("ACCESS_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+ACCESS_LOG_BACKUPS = int(os.getenv("ACCESS_LOG_BACKUPS", "5"))
+ACCESS_LOG_COMPRESS = os.getenv("ACCESS_LOG_COMPRESS", "0") == "1"
+
+current_request_id = contextvars.ContextVar("current_request_id", default=None)
+current_game = contextvars.ContextVar("current_game", default=None)
+
+
+class JsonLinesWriter:
+    """
+    Asynchronous JSON-lines log file. Callers only enqueue a dict; one
+    background thread encodes records in batches, rotates by size and
+    optionally gzips rotated files. Records are dropped (and counted)
+    rather than blocking when the queue is full.
+    """
+
+    def __init__(self, path: str, max_bytes: int, backups: int, compress: bool,
+                 batch_size: int = 500, queue_size: int = 20000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = open(path, "a", encoding="utf-8")
+        self._thread = threading.Thread(target=self._run, name="access-log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, record: dict):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            closing = None in batch
+            lines = "".join(
+                json.dumps(record, separators=(",", ":"), default=str) + "\n"
+                for record in batch if record is not None
+            )
+            try:
+                self._file.write(lines)
+                self._file.flush()
+                if self._file.tell() >= self.max_bytes:
+                    self._rotate()
+            except OSError:
+                self.dropped += len(batch)
+
+            if closing:
+                self._file.close()
+                return
+
+    def _rotate(self):
+        self._file.close()
+        suffix = ".gz" if self.compress else ""
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                src = f"{self.path}.{i}{suffix}"
+                if os.path.exists(src):
+                    os.replace(src, f"{self.path}.{i + 1}{suffix}")
+            if self.compress:
+                with open(self.path, "rb") as src, gzip.open(f"{self.path}.1.gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(self.path)
+            else:
+                os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, "w", encoding="utf-8")
+
+
+access_log = (
+    JsonLinesWriter(ACCESS_LOG_PATH, ACCESS_LOG_MAX_BYTES, ACCESS_LOG_BACKUPS, ACCESS_LOG_COMPRESS)
+    if ACCESS_LOG_PATH else None
 )
-app.add_middleware(SlowAPIMiddleware)
 
-# ✅ Dependency: API key + IP check
-def verify_api_key(request: Request):
-    api_key = request.query_params.get("api_key")
-    client_ip = request.client.host
 
-    if api_key not in VALID_API_KEYS:
-        raise HTTPException(status_code=401, detail="Invalid API key")
+# Keys are short enough to brute-force from a plain hash, so ids are an HMAC.
+# Unset = random per process: ids (and USAGE_PATH history) don't survive a restart.
+KEY_ID_SECRET = (os.getenv("KEY_ID_SECRET") or os.urandom(32).hex()).encode()
+
+
+def key_id(api_key: str):
+    """Short, non-reversible identifier for an API key (never log the key itself)."""
+    if not api_key:
+        return None
+    return hmac.new(KEY_ID_SECRET, api_key.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def log_upstream_attempt(method: str, url: str, status, error, elapsed_ms: float):
+    parts = urlsplit(url)
+    access_log.write({
+        "ts": time.time(),
+        "type": "upstream",
+        "request_id": current_request_id.get(),
+        "game": current_game.get(),
+        "provider": parts.netloc,
+        "path": parts.path,
+        "method": method,
+        "status": status,
+        "outcome": "error" if error else ("ok" if status and status < 400 else "http_error"),
+        "error": error,
+        "duration_ms": round(elapsed_ms, 1),
+    })
 
-    allowed_ip = VALID_API_KEYS[api_key]
-    if client_ip != allowed_ip:
-        raise HTTPException(status_code=401, detail=f"API key not allowed from IP {client_ip}")
 
-    return api_key
+class AccessLogMiddleware:
+    """
+    One JSON line per request; costs a dict + enqueue. Pure ASGI and only
+    installed when ACCESS_LOG_PATH is set, so disabled logging costs nothing.
+    """
 
-def safe_description(endpoint):
-    try:
-        desc = endpoint.__doc__
-        if not desc:
-            return ""
-        # Strip whitespace and replace newlines with spaces
-        return " ".join(desc.strip().split())
-    except Exception:
-        return ""
+    def __init__(self, app):
+        self.app = app
 
-@app.get("/")
-def root():
-    endpoints = []
-    for route in app.routes:
-        if isinstance(route, APIRoute):
-            path = route.path
-            methods = list(route.methods - {"HEAD", "OPTIONS"})
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
 
-            # ✅ use safe function
-            description = safe_description(route.endpoint)
+        request_id = os.urandom(8).hex()
+        current_request_id.set(request_id)
+        started = time.monotonic()
+        status = None
 
-            # --- Build example URL ---
-            base_url = "https://tangyanstore.vercel.app"
-            params = []
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", ()), (b"x-request-id", request_id.encode())]
+            await send(message)
 
-            # Add params based on function signature
-            func_params = route.dependant.query_params
-            for p in func_params:
-                if p.name == "id":
-                    params.append("id=xxxxxxxxxx")
-                elif p.name == "zone":
-                    params.append("zone=xxxx")
+        await self.app(scope, receive, send_wrapper)
 
-            # always append api_key
-            params.append("api_key=xxxxx")
+        request = Request(scope)
+        lookup = scope.get("state", {}).get("lookup") or {}
+        access_log.write({
+            "ts": time.time(),
+            "type": "request",
+            "request_id": request_id,
+            "method": scope["method"],
+            "route": scope["path"],
+            "game": lookup.get("game") or lookup_game_for_path(scope["path"]),
+            "key_id": key_id(request_api_key(request)),
+            "cache": lookup.get("cache"),
+            "outcome": lookup.get("outcome") or ("ok" if status and status < 400 else "rejected"),
+            "status": status,
+            "duration_ms": round((time.monotonic() - started) * 1000, 1),
+        })
 
-            example = f"{base_url}{path}?{'&'.join(params)}" if params else f"{base_url}{path}?api_key=xxxxx"
 
-            endpoints.append({
-                "path": path,
-                "methods": methods,
-                "description": description,
-                "example": example
-                
+if access_log:
+    app.add_middleware(AccessLogMiddleware)
+
+
+@app.on_event("shutdown")
+def close_access_log():
+    if access_log:
+        access_log.close()
+    if capture_log:
+        capture_log.close()
+
+
+# ------------------------------
+# Usage analytics (per key / game / outcome / minute)
+# ------------------------------
+
+USAGE_PATH = os.getenv("USAGE_PATH")     # *.db / *.sqlite = SQLite table, else JSON lines; unset = off
+USAGE_FLUSH_INTERVAL = int(os.getenv("USAGE_FLUSH_INTERVAL", "60"))
+USAGE_MAX_MINUTES = 31 * 24 * 60         # longest window /usage will report
+USAGE_LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)   # ms upper bounds (+ overflow)
+USAGE_COUNTERS = ("requests", "cache_hits", "upstream_calls", "latency_ms_sum")
+USAGE_BUCKET_COLUMNS = [f"le_{bound}" for bound in USAGE_LATENCY_BUCKETS] + ["le_inf"]
+
+
+class UsageRecorder:
+    """
+    In-memory usage aggregates keyed by (api key, game, outcome, minute),
+    flushed in bulk every `flush_interval` seconds to an append-only JSON
+    lines file or an upserted SQLite table. Recording is one dict lookup
+    and a few additions under a lock; keys are stored hashed (key_id).
+    """
+
+    def __init__(self, path: str, flush_interval: int):
+        self.path = path
+        self.sqlite = path.endswith((".db", ".sqlite", ".sqlite3"))
+        self.flush_interval = flush_interval
+        self.flushed_rows = 0
+        self.flush_errors = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._stop = threading.Event()
+        if self.sqlite:
+            self._init_sqlite()
+        self._thread = threading.Thread(target=self._run, name="usage-flush", daemon=True)
+        self._thread.start()
+
+    def record(self, api_key, game: str, outcome: str, cache_hit: bool, upstream_calls: int, latency_ms: float):
+        bucket = (api_key, game, outcome, int(time.time() // 60) * 60)
+        with self._lock:
+            row = self._pending.get(bucket)
+            if row is None:
+                row = self._pending[bucket] = [0, 0, 0, 0.0, 0.0] + [0] * len(USAGE_BUCKET_COLUMNS)
+            row[0] += 1
+            row[1] += cache_hit
+            row[2] += upstream_calls
+            row[3] += latency_ms
+            if latency_ms > row[4]:
+                row[4] = latency_ms
+            row[5 + bisect.bisect_left(USAGE_LATENCY_BUCKETS, latency_ms)] += 1
+
+    @staticmethod
+    def _row_dict(bucket, row) -> dict:
+        api_key, game, outcome, minute = bucket
+        return {
+            "key_id": key_id(api_key), "game": game, "outcome": outcome, "minute": minute,
+            **dict(zip(USAGE_COUNTERS, row[:4])), "latency_ms_max": row[4],
+            **dict(zip(USAGE_BUCKET_COLUMNS, row[5:])),
+        }
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        rows = [self._row_dict(bucket, row) for bucket, row in pending.items()]
+        try:
+            with self._io_lock:
+                if self.sqlite:
+                    self._write_sqlite(rows)
+                else:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write("".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows))
+            self.flushed_rows += len(rows)
+        except (OSError, sqlite3.Error):
+            self.flush_errors += 1
+            # keep the counts for the next attempt
+            with self._lock:
+                for bucket, row in pending.items():
+                    current = self._pending.setdefault(bucket, [0] * len(row))
+                    for i, value in enumerate(row):
+                        current[i] = max(current[i], value) if i == 4 else current[i] + value
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def _init_sqlite(self):
+        columns = ", ".join(f"{column} INTEGER NOT NULL" for column in USAGE_BUCKET_COLUMNS)
+        with sqlite3.connect(self.path) as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "key_id TEXT, game TEXT, outcome TEXT, minute INTEGER, "
+                "requests INTEGER NOT NULL, cache_hits INTEGER NOT NULL, upstream_calls INTEGER NOT NULL, "
+                f"latency_ms_sum REAL NOT NULL, latency_ms_max REAL NOT NULL, {columns}, "
+                "PRIMARY KEY (key_id, game, outcome, minute))"
+            )
+
+    def _write_sqlite(self, rows: list):
+        columns = ["key_id", "game", "outcome", "minute", *USAGE_COUNTERS, "latency_ms_max", *USAGE_BUCKET_COLUMNS]
+        updates = [f"{column} = {column} + excluded.{column}" for column in (*USAGE_COUNTERS, *USAGE_BUCKET_COLUMNS)]
+        updates.append("latency_ms_max = MAX(latency_ms_max, excluded.latency_ms_max)")
+        with sqlite3.connect(self.path) as db:
+            db.executemany(
+                f"INSERT INTO usage ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT (key_id, game, outcome, minute) DO UPDATE SET {', '.join(updates)}",
+                [tuple(row[column] for column in columns) for row in rows],
+            )
+
+    def _stored_rows(self, kid: str, since: int):
+        if self.sqlite:
+            with sqlite3.connect(self.path) as db:
+                db.row_factory = sqlite3.Row
+                yield from map(dict, db.execute("SELECT * FROM usage WHERE key_id = ? AND minute >= ?", (kid, since)))
+            return
+        if not os.path.exists(self.path):
+            return
+        needle = f'"key_id":"{kid}"'
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if needle in line:
+                    row = json.loads(line)
+                    if row["minute"] >= since:
+                        yield row
+
+    def report(self, api_key: str, minutes: int) -> dict:
+        """Usage totals per game for one API key over the last `minutes` (flushed + pending)."""
+        kid, since = key_id(api_key), int(time.time() // 60 - minutes + 1) * 60
+        with self._lock:
+            pending = [
+                self._row_dict(bucket, row) for bucket, row in self._pending.items()
+                if bucket[0] == api_key and bucket[3] >= since
+            ]
+        with self._io_lock:
+            rows = list(self._stored_rows(kid, since))
+
+        games = {}
+        for row in rows + pending:
+            game = games.setdefault(row["game"], {
+                **dict.fromkeys(USAGE_COUNTERS, 0), "latency_ms_max": 0.0,
+                "buckets": [0] * len(USAGE_BUCKET_COLUMNS), "outcomes": {},
             })
+            for counter in USAGE_COUNTERS:
+                game[counter] += row[counter]
+            game["latency_ms_max"] = max(game["latency_ms_max"], row["latency_ms_max"])
+            for i, column in enumerate(USAGE_BUCKET_COLUMNS):
+                game["buckets"][i] += row[column]
+            game["outcomes"][row["outcome"]] = game["outcomes"].get(row["outcome"], 0) + row["requests"]
+
+        for game in games.values():
+            buckets, requests_ = game.pop("buckets"), game["requests"]
+            game["latency_ms_avg"] = round(game.pop("latency_ms_sum") / requests_, 1) if requests_ else 0.0
+            game["latency_ms_max"] = round(game["latency_ms_max"], 1)
+            game["latency_ms_p95"] = usage_percentile(buckets, 95)
+        return {
+            "key_id": kid,
+            "since": since,
+            "total_requests": sum(game["requests"] for game in games.values()),
+            "games": games,
+        }
 
-    return {
-        "version": "2.0",
-        "code": 200,
-        "author": "Sanjoy",
-        "contact": "91 9862622104",
-        "status": True,
-        "message": "Game IGN Checker API running",
-        "available_endpoints": endpoints
-    }
 
+def usage_percentile(buckets: list, pct: float):
+    """Upper bound (ms) of the latency bucket holding the pct-th percentile; None past the last bound."""
+    total, seen = sum(buckets), 0
+    for bound, count in zip(USAGE_LATENCY_BUCKETS + (None,), buckets):
+        seen += count
+        if total and seen >= total * pct / 100:
+            return bound
+    return 0
 
-# ✅ Helper response formatter
-def format_response(success: bool, message: str, data: dict = None, code: int = 200):
+
+usage = UsageRecorder(USAGE_PATH, USAGE_FLUSH_INTERVAL) if USAGE_PATH else None
+
+
+if usage:
+    @app.on_event("shutdown")
+    def flush_usage():
+        usage.close()
+
+    @app.get("/usage")
+    def usage_report(
+        minutes: int = Query(1440, ge=1, le=USAGE_MAX_MINUTES),
+        api_key: str = Depends(verify_api_key),
+    ):
+        """
+        Usage of the calling API key per game over the last `minutes`.
+        """
+        report = usage.report(api_key, minutes)
+        return format_response(True, f"{report['total_requests']} lookup(s)", report)
+
+
+# ------------------------------
+# Traffic capture (for scripts/replay_traffic.py)
+# ------------------------------
+
+CAPTURE_PATH = os.getenv("CAPTURE_PATH")                  # unset = capture off
+
+current_capture = contextvars.ContextVar("current_capture", default=None)
+
+capture_log = (
+    JsonLinesWriter(CAPTURE_PATH, ACCESS_LOG_MAX_BYTES, ACCESS_LOG_BACKUPS, ACCESS_LOG_COMPRESS)
+    if CAPTURE_PATH else None
+)
+
+
+def capture_upstream(method: str, url: str, data, response, error, elapsed_ms: float) -> dict:
+    """Raw upstream exchange as recorded for replay."""
     return {
-        "code": code,
-        "status": success,
-        "message": message,
-        "data": data or {}
+        "method": method,
+        "url": url,
+        "data": data,
+        "status": response.status_code if response is not None else None,
+        "content_type": response.headers.get("content-type") if response is not None else None,
+        "body": response.text if response is not None else None,
+        "error": error,
+        "elapsed_ms": round(elapsed_ms, 1),
     }
 
-@app.get("/health")
-def health_check():
-    return {"status": "healthy"}
 
+def is_captured_path(path: str) -> bool:
+    return path == "/games/discover" or lookup_game_for_path(path) is not None
+
+
+class CaptureMiddleware:
+    """
+    Record lookup traffic (api_key anonymised) with the upstream responses
+    behind it. Pure ASGI and only installed when CAPTURE_PATH is set.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not is_captured_path(scope["path"]):
+            return await self.app(scope, receive, send)
+
+        upstream = []
+        current_capture.set(upstream)
+        started = time.monotonic()
+        status = None
+        body = []
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                body.append(message.get("body", b""))
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+        elapsed_ms = (time.monotonic() - started) * 1000
+
+        request = Request(scope)
+        params = dict(request.query_params)
+        params.pop("api_key", None)
+        capture_log.write({
+            "ts": time.time(),
+            "route": scope["path"],
+            "params": params,
+            "key_id": key_id(request_api_key(request)),
+            "status": status,
+            "body": b"".join(body).decode("utf-8", "replace"),
+            "duration_ms": round(elapsed_ms, 1),
+            "upstream": upstream,
+        })
+
+
+if capture_log:
+    app.add_middleware(CaptureMiddleware)
+
+
+# ------------------------------
+# Event-loop lag + worker saturation
+# ------------------------------
+
+LOOP_LAG_INTERVAL = 0.5
+SATURATION_LAG_MS = float(os.getenv("SATURATION_LAG_MS", "250"))
+SATURATION_POOL_WAITING = int(os.getenv("SATURATION_POOL_WAITING", "20"))
+SATURATION_HANDLER_WAIT_MS = float(os.getenv("SATURATION_HANDLER_WAIT_MS", "500"))
+
+current_arrival = contextvars.ContextVar("current_arrival", default=None)
+
+SATURATION_WINDOW = 60      # seconds of samples behind each report
+
+loop_lag_samples = deque(maxlen=int(SATURATION_WINDOW / LOOP_LAG_INTERVAL))
+handler_wait_samples = deque(maxlen=1000)       # (monotonic time, wait ms)
+pool_stats = {"busy": 0, "size": 0, "waiting": 0}
+route_inflight = {}
+ROUTE_PATHS = set()
+
+
+async def loop_lag_monitor():
+    """Measure how late the event loop wakes us, and sample the request pool while here."""
+    loop = asyncio.get_running_loop()
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag_samples.append(max(0.0, (loop.time() - expected) * 1000))
+        pool_stats.update(
+            busy=limiter.borrowed_tokens,
+            size=limiter.total_tokens,
+            waiting=limiter.statistics().tasks_waiting,
+        )
 
 
+@app.on_event("startup")
+async def start_loop_monitor():
+    app.state.loop_monitor = asyncio.create_task(loop_lag_monitor())
+
+
+def record_handler_wait():
+    """Called as a handler starts: time since the request reached the app."""
+    arrival = current_arrival.get()
+    if arrival is not None:
+        now = time.monotonic()
+        handler_wait_samples.append((now, (now - arrival) * 1000))
+
+
+def route_label(path: str) -> str:
+    if not ROUTE_PATHS:
+        ROUTE_PATHS.update(route.path for route in app.routes)
+    return path if path in ROUTE_PATHS else "other"
+
+
+class SaturationMiddleware:
+    """Arrival time (for handler wait) and in-flight count per route; pure ASGI."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        current_arrival.set(time.monotonic())
+        route = route_label(scope["path"])
+        route_inflight[route] = route_inflight.get(route, 0) + 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route_inflight[route] -= 1
+
+
+app.add_middleware(SaturationMiddleware)
+
+
+def percentile_of(samples, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct))], 1)
+
+
+def saturation_report() -> dict:
+    lag = list(loop_lag_samples)
+    # Only recent waits: a drained instance gets no new lookups to push old ones out
+    since = time.monotonic() - SATURATION_WINDOW
+    waits = [wait for at, wait in list(handler_wait_samples) if at >= since]
+    report = {
+        "loop_lag_ms": round(lag[-1], 1) if lag else 0.0,
+        "loop_lag_max_ms": round(max(lag), 1) if lag else 0.0,
+        "pool_busy": pool_stats["busy"],
+        "pool_size": pool_stats["size"],
+        "pool_waiting": pool_stats["waiting"],
+        "handler_wait_p50_ms": percentile_of(waits, 0.5),
+        "handler_wait_p99_ms": percentile_of(waits, 0.99),
+        "inflight": {route: count for route, count in route_inflight.items() if count},
+    }
+    report["saturated"] = (
+        report["loop_lag_ms"] > SATURATION_LAG_MS
+        or report["pool_waiting"] > SATURATION_POOL_WAITING
+        or report["handler_wait_p50_ms"] > SATURATION_HANDLER_WAIT_MS
+    )
+    return report
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Saturation metrics in Prometheus text format.
+    """
+    report = saturation_report()
+    lines = []
+    for name in ("loop_lag_ms", "loop_lag_max_ms", "pool_busy", "pool_size", "pool_waiting",
+                 "handler_wait_p50_ms", "handler_wait_p99_ms"):
+        lines.append(f"# TYPE ign_api_{name} gauge")
+        lines.append(f"ign_api_{name} {report[name]}")
+    lines.append("# TYPE ign_api_saturated gauge")
+    lines.append(f"ign_api_saturated {int(report['saturated'])}")
+    if isinstance(LOOKUP_CACHE, CompactLookupCache):
+        for name, value in LOOKUP_CACHE.memory_report().items():
+            if value is not None:
+                lines.append(f"# TYPE ign_api_lookup_cache_{name} gauge")
+                lines.append(f"ign_api_lookup_cache_{name} {value}")
+    for name, value in abandoned.items():
+        lines.append(f"# TYPE ign_api_abandoned_{name} gauge")
+        lines.append(f"ign_api_abandoned_{name} {value}")
+    if negative_filter:
+        for name, value in negative_filter.report().items():
+            lines.append(f"# TYPE ign_api_negative_filter_{name} gauge")
+            lines.append(f"ign_api_negative_filter_{name} {value}")
+    if rate_limiter:
+        for name, value in rate_limiter.stats.items():
+            lines.append(f"# TYPE ign_api_rate_{name} gauge")
+            lines.append(f"ign_api_rate_{name} {value}")
+    if cluster is not None:
+        for name in ("peer_hits", "peer_misses", "peer_errors", "replicated"):
+            lines.append(f"# TYPE ign_api_cluster_{name} gauge")
+            lines.append(f"ign_api_cluster_{name} {cluster.stats[name]}")
+    lines.append("# TYPE ign_api_inflight_requests gauge")
+    for route, count in route_inflight.items():
+        lines.append(f'ign_api_inflight_requests{{route="{route}"}} {count}')
+    return PlainTextResponse("\n".join(lines) + "\n")
 
 
 # ------------------------------
@@ -131,7 +3183,7 @@ def health_check():
 # ------------------------------
 
 @app.get("/check_region")
-@limiter.limit("100/day")
+@game_lookup("mlbb_region")
 def check_region(
     request: Request,
     id: str,
@@ -141,16 +3193,11 @@ def check_region(
     """
     Check Mobile Legends Bang Bang Region
     """
-    urls = [
-        f"https://regionweb.vercel.app/api/validasi?id={id}&serverid={zone}",
-        f"https://gameidcheckerenglish.vercel.app/api/game/check-region-mlbb?id={id}&zone={zone}",
-        f"https://gameidcheckerenglish.vercel.app/api/game/cek-region-mlbb-m?id={id}&zone={zone}"
-        
-    ]
+    urls = provider_urls("mlbb_region", id=id, zone=zone)
 
     for url in urls:
         try:
-            response = requests.get(url, timeout=10)
+            response = upstream_get(url)
             response.raise_for_status()
             result = response.json()
 
@@ -210,26 +3257,28 @@ def generate_sign(params: dict) -> str:
 # Mobile Legends Brazil (Smile.One)
 # ============================
 @app.get("/games/ml_role_brazil")
+@game_lookup("ml_role_brazil")
 def check_ml_role_brazil(request: Request, id: str, zone: str, _: str = Depends(verify_api_key)):
     """
     Check Mobile Legends Bang Bang (smile Brazil/Global) ID.
     """
 
-    url = "https://www.smile.one/br/smilecoin/api/getrole"
+    product = ROUTING["smile_one"]["ml_role_brazil"]
+    url = product["url"]
 
     payload = {
         "email": EMAIL,
         "uid": UID,
         "userid": id,
         "zoneid": zone,
-        "product": "mobilelegends",
-        "productid": "13",  # Brazil product ID
+        "product": product["product"],
+        "productid": product["productid"],
         "time": str(int(time.time()))
     }
     payload["sign"] = generate_sign(payload)
 
     try:
-        response = requests.post(url, data=payload, timeout=10)
+        response = upstream_post(url, data=payload)
         res_json = response.json()
 
         if res_json.get("status") == 200:
@@ -258,19 +3307,21 @@ def check_ml_role_brazil(request: Request, id: str, zone: str, _: str = Depends(
 # MLBB Brazil WKP (Smile.One)
 # ------------------------------
 @app.get("/games/ml_role_brazil_wkp")
+@game_lookup("ml_role_brazil_wkp", cache=False)
 def check_ml_role_brazil_wkp(request: Request, id: str, zone: str, _: str = Depends(verify_api_key)):
     """
     Check Mobile Legends Bang Bang (Bralin Weekly Pass Limit) ID.
     """
-    url = "https://www.smile.one/br/smilecoin/api/getrole"
+    product = ROUTING["smile_one"]["ml_role_brazil_wkp"]
+    url = product["url"]
 
     payload = {
         "email": EMAIL,
         "uid": UID,
         "userid": id,
         "zoneid": zone,
-        "product": "mobilelegends",
-        "productid": "16642",  # WKP Brazil product id
+        "product": product["product"],
+        "productid": product["productid"],
         "time": str(int(time.time()))
     }
     payload["sign"] = generate_sign(payload)
@@ -285,7 +3336,7 @@ def check_ml_role_brazil_wkp(request: Request, id: str, zone: str, _: str = Depe
     }
 
     try:
-        response = requests.post(url, data=payload, timeout=10)
+        response = upstream_post(url, data=payload)
         res_json = response.json()
 
         message = res_json.get("message", "Unknown Error")
@@ -318,25 +3369,27 @@ def check_ml_role_brazil_wkp(request: Request, id: str, zone: str, _: str = Depe
 # MLBB Philippines (Smile.One)
 # ------------------------------
 @app.get("/games/ml_role_php")
+@game_lookup("ml_role_php")
 def check_ml_role_php(request: Request, id: str, zone: str, _: str = Depends(verify_api_key)):
     """
     Check Mobile Legends Bang Bang (Philippines) ID.
     """
-    url = "https://www.smile.one/ph/smilecoin/api/getrole"
+    product = ROUTING["smile_one"]["ml_role_php"]
+    url = product["url"]
 
     payload = {
         "email": EMAIL,
         "uid": UID,
         "userid": id,
         "zoneid": zone,
-        "product": "mobilelegends",
-        "productid": "212",  # Philippines product id
+        "product": product["product"],
+        "productid": product["productid"],
         "time": str(int(time.time()))
     }
     payload["sign"] = generate_sign(payload)
 
     try:
-        response = requests.post(url, data=payload, timeout=10)
+        response = upstream_post(url, data=payload)
         res_json = response.json()
 
         if res_json.get("status") == 200:
@@ -365,26 +3418,28 @@ def check_ml_role_php(request: Request, id: str, zone: str, _: str = Depends(ver
 # MLBB Russia (Smile.One)
 # ------------------------------
 @app.get("/games/ml_role_ru")
-def check_ml_role_ru(id: str, zone: str, _: str = Depends(verify_api_key)):
+@game_lookup("ml_role_ru")
+def check_ml_role_ru(request: Request, id: str, zone: str, _: str = Depends(verify_api_key)):
 
     """
     Check Mobile Legends Bang Bang (Russia) ID.
     """
-    url = "https://www.smile.one/ru/smilecoin/api/getrole"
+    product = ROUTING["smile_one"]["ml_role_ru"]
+    url = product["url"]
 
     payload = {
         "email": EMAIL,
         "uid": UID,
         "userid": id,
         "zoneid": zone,
-        "product": "mobilelegends",
-        "productid": "250",  # Russia product id
+        "product": product["product"],
+        "productid": product["productid"],
         "time": str(int(time.time()))
     }
     payload["sign"] = generate_sign(payload)
 
     try:
-        response = requests.post(url, data=payload, timeout=10)
+        response = upstream_post(url, data=payload)
         res_json = response.json()
 
         if res_json.get("status") == 200:
@@ -414,23 +3469,18 @@ def check_ml_role_ru(id: str, zone: str, _: str = Depends(verify_api_key)):
 # ------------------------------
 
 @app.get("/games/ml_ign")
-@limiter.limit("100/day")
+@game_lookup("ml_ign")
 def check_mlbb(request: Request, id: str, zone: str, _: str = Depends(verify_api_key)):
     """
     Check Mobile Legends Bang Bang (all regions) ID
     """
 
     # ✅ API endpoints (fallback order)
-    urls = [
-        f"https://sanjoymrc.vercel.app/api/game/mobile-legends-mp?id={id}&zone={zone}",
-        f"https://c-node-amber.vercel.app/api/game/mobile-legends-mp?id={id}&zone={zone}",
-        f"https://cek-id-game.vercel.app/api/game/mobile-legends-mp?id={id}&zone={zone}",
-        f"https://gameidcheckerenglish.vercel.app/api/game/mobile-legends-mp?id={id}&zone={zone}"
-    ]
+    urls = provider_urls("ml_ign", id=id, zone=zone)
 
-    for url in urls:
+    for url in balance_urls(urls):
         try:
-            response = requests.get(url, timeout=10)
+            response = upstream_get(url)
             result = response.json()
 
             # ✅ Success check
@@ -462,7 +3512,7 @@ def check_mlbb(request: Request, id: str, zone: str, _: str = Depends(verify_api
 # ------------------------------
 
 @app.get("/games/ml_indo_id")
-@limiter.limit("100/day")
+@game_lookup("ml_indo_id")
 def check_mlbb_indo(request: Request, id: str, zone: str, _: str = Depends(verify_api_key)):
     """
     Check Mobile Legends Bang Bang (Indonesia) ID only.
@@ -470,10 +3520,10 @@ def check_mlbb_indo(request: Request, id: str, zone: str, _: str = Depends(verif
     Returns simplified JSON format.
     """
 
-    url = f"https://gameidcheckerenglish.vercel.app/api/game/cek-region-mlbb-m?id={id}&zone={zone}"
+    url = provider_urls("ml_indo_id", id=id, zone=zone)[0]
 
     try:
-        response = requests.get(url, timeout=10)
+        response = upstream_get(url)
         response.raise_for_status()
         result = response.json()
 
@@ -519,23 +3569,18 @@ def check_mlbb_indo(request: Request, id: str, zone: str, _: str = Depends(verif
 # ------------------------------
 
 @app.get("/games/mobile_legends_adventure")
-@limiter.limit("100/day")
+@game_lookup("mobile_legends_adventure")
 def check_mobile_legends_adventure(request: Request, id: str, zone: str, _: str = Depends(verify_api_key)):
     """
     Check Mobile Legends Adventure ID with multiple fallback APIs.
     """
 
     # ✅ API endpoints to try
-    urls = [
-        f"https://gameidcheckerenglish.vercel.app/api/game/mobile-legends-adventure?id={id}&zone={zone}",
-        f"https://cek-id-game.vercel.app/api/game/mobile-legends-adventure?id={id}&zone={zone}",
-        f"https://c-node-amber.vercel.app/api/game/mobile-legends-adventure?id={id}&zone={zone}",
-        f"https://sanjoymrc.vercel.app/api/game/mobile-legends-adventure?id={id}&zone={zone}"
-    ]
+    urls = provider_urls("mobile_legends_adventure", id=id, zone=zone)
 
-    for url in urls:
+    for url in balance_urls(urls):
         try:
-            response = requests.get(url, timeout=10)
+            response = upstream_get(url)
             result = response.json()
 
             # ✅ Success check
@@ -567,22 +3612,18 @@ def check_mobile_legends_adventure(request: Request, id: str, zone: str, _: str
 # ------------------------------
 
 @app.get("/games/magic_chess_go_go")
-@limiter.limit("100/day")
+@game_lookup("magic_chess_go_go")
 def check_magic_chess_gogo(request: Request, id: str, zone: str, _: str = Depends(verify_api_key)):
     """
     Check Magic Chess Go Go ID with multiple fallback APIs.
     """
 
     # ✅ API endpoints to try (fallback system)
-    urls = [
-        f"https://gameidcheckerenglish.vercel.app/api/game/magic-chess-go-go?id={id}&zone={zone}",
-        f"https://c-node-amber.vercel.app/api/game/magic-chess-go-go?id={id}&zone={zone}",
-        f"https://sanjoymrc.vercel.app/api/game/magic-chess-go-go?id={id}&zone={zone}"
-    ]
+    urls = provider_urls("magic_chess_go_go", id=id, zone=zone)
 
-    for url in urls:
+    for url in balance_urls(urls):
         try:
-            response = requests.get(url, timeout=10)
+            response = upstream_get(url)
             result = response.json()
 
             # ✅ Success check
@@ -614,14 +3655,15 @@ def check_magic_chess_gogo(request: Request, id: str, zone: str, _: str = Depend
 # MLBB Double Diamonds (Custom API)
 # ------------------------------
 @app.get("/check_double_diamonds")
-def check_double_diamonds(id: str, zone: str, _: str = Depends(verify_api_key)):
+@game_lookup("double_diamonds")
+def check_double_diamonds(request: Request, id: str, zone: str, _: str = Depends(verify_api_key)):
     """
     Check mlbb double diamonds ID.
     """
-    url = f"https://doublediamonds.vercel.app/?id={id}&zone={zone}"
+    url = provider_urls("double_diamonds", id=id, zone=zone)[0]
 
     try:
-        response = requests.get(url, timeout=10)
+        response = upstream_get(url)
         res_json = response.json()
 
         # If username found, success
@@ -654,14 +3696,14 @@ def check_double_diamonds(id: str, zone: str, _: str = Depends(verify_api_key)):
 # ------------------------------
 
 @app.get("/games/bgmi")
-@limiter.limit("100/day")
+@game_lookup("bgmi")
 def check_bgmi_username(request: Request, id: str, _: str = Depends(verify_api_key)):
     """
     Check bgmi ID .
     """
-    url = f"https://bgmi-nine.vercel.app/getUsername?id={id}"
+    url = provider_urls("bgmi", id=id)[0]
     try:
-        response = requests.get(url, timeout=10)
+        response = upstream_get(url)
         result = response.json()
 
         if result.get("message") == "SUCCESS":
@@ -690,20 +3732,16 @@ def check_bgmi_username(request: Request, id: str, _: str = Depends(verify_api_k
 # ------------------------------
 
 @app.get("/games/pubg_mobile_global")
-@limiter.limit("100/day")
+@game_lookup("pubg_mobile_global")
 def check_pubg_mobile_global(request: Request, id: str, _: str = Depends(verify_api_key)):
     """
     Check pubg mobile global ID.
     """
-    urls = [
-        f"https://gameidcheckerenglish.vercel.app/api/game/pubg-mobile-tp?id={id}",
-        f"https://gameidcheckerenglish.vercel.app/api/game/pubg-mobile-global-vc?id={id}",
-        f"https://gameidcheckerenglish.vercel.app/api/game/pubg-mobile-vc?id={id}"
-    ]
+    urls = provider_urls("pubg_mobile_global", id=id)
 
     for url in urls:
         try:
-            response = requests.get(url, timeout=10)
+            response = upstream_get(url)
             response.raise_for_status()
             result = response.json()
 
@@ -725,20 +3763,16 @@ def check_pubg_mobile_global(request: Request, id: str, _: str = Depends(verify_
 # ------------------------------ 
 
 @app.get("/games/honor_of_kings")
-@limiter.limit("100/day")
+@game_lookup("honor_of_kings")
 def check_honor_of_kings(request: Request, id: str, _: str = Depends(verify_api_key)):
     """
     Check Honor of Kings ID.
     """
-    urls = [
-        f"https://gameidcheckerenglish.vercel.app/api/game/honor-of-kings-tp?id={id}",
-        f"https://gameidcheckerenglish.vercel.app/api/game/honor-of-kings-vc?id={id}",
-        f"https://gameidcheckerenglish.vercel.app/api/game/honor-of-kings?id={id}"
-    ]
+    urls = provider_urls("honor_of_kings", id=id)
 
     for url in urls:
         try:
-            response = requests.get(url, timeout=10)
+            response = upstream_get(url)
             response.raise_for_status()
             result = response.json()
 
@@ -761,14 +3795,14 @@ def check_honor_of_kings(request: Request, id: str, _: str = Depends(verify_api_
 # ------------------------------
 
 @app.get("/games/8_ball_pool")
-@limiter.limit("100/day")
+@game_lookup("8_ball_pool")
 def check_8ball_pool(request: Request, id: str, _: str = Depends(verify_api_key)):
     """
     Check 8 Ball Pool ID.
     """
-    url = f"https://c-node-amber.vercel.app/api/game/8-ball-pool?id={id}"
+    url = provider_urls("8_ball_pool", id=id)[0]
     try:
-        response = requests.get(url, timeout=10)
+        response = upstream_get(url)
         result = response.json()
 
         # ✅ If API failed with 500/404 → return clean Wrong ID
@@ -796,14 +3830,14 @@ def check_8ball_pool(request: Request, id: str, _: str = Depends(verify_api_key)
 # ------------------------------
 
 @app.get("/games/blood_strike")
-@limiter.limit("100/day")
+@game_lookup("blood_strike")
 def check_blood_strike(request: Request, id: str, _: str = Depends(verify_api_key)):
     """
     Check Blood Strike ID.
     """
-    url = f"https://gameidcheckerenglish.vercel.app/api/game/blood-strike?id={id}&zone=-1"
+    url = provider_urls("blood_strike", id=id)[0]
     try:
-        response = requests.get(url, timeout=10)
+        response = upstream_get(url)
         result = response.json()
 
         # ❌ Wrong ID case
@@ -836,14 +3870,14 @@ def check_blood_strike(request: Request, id: str, _: str = Depends(verify_api_ke
 # ------------------------------
 
 @app.get("/games/honkai_impact_3")
-@limiter.limit("100/day")
+@game_lookup("honkai_impact_3")
 def check_honkai_impact_3(request: Request, id: str, _: str = Depends(verify_api_key)):
     """
     Check Honkai Impact 3 ID.
     """
-    url = f"https://gameidcheckerenglish.vercel.app/api/game/honkai-impact-3?id={id}"
+    url = provider_urls("honkai_impact_3", id=id)[0]
     try:
-        response = requests.get(url, timeout=10)
+        response = upstream_get(url)
         result = response.json()
 
         # ❌ Wrong ID case
@@ -876,19 +3910,16 @@ def check_honkai_impact_3(request: Request, id: str, _: str = Depends(verify_api
 # ------------------------------
 
 @app.get("/games/super_sus")
-@limiter.limit("100/day")
+@game_lookup("super_sus")
 def check_super_sus(request: Request, id: str, _: str = Depends(verify_api_key)):
     """
     Check Super Sus ID .
     """
-    urls = [
-        f"https://gameidcheckerenglish.vercel.app/api/game/super-sus?id={id}",
-        f"https://gameidcheckerenglish.vercel.app/api/game/super-sus-vc?id={id}"
-    ]
+    urls = provider_urls("super_sus", id=id)
 
     for url in urls:
         try:
-            response = requests.get(url, timeout=10)
+            response = upstream_get(url)
             result = response.json()
 
             # ❌ Wrong ID case
@@ -920,15 +3951,15 @@ def check_super_sus(request: Request, id: str, _: str = Depends(verify_api_key))
 
 # ✅ Arena of Valor
 @app.get("/games/arena_of_valor")
-@limiter.limit("100/day")
+@game_lookup("arena_of_valor")
 def check_arena_of_valor(request: Request, id: str, _: str = Depends(verify_api_key)):
     """
     Check Arena of Valor ID .
     """
-    url = f"https://c-node-amber.vercel.app/api/game/arena-of-valor?id={id}"
+    url = provider_urls("arena_of_valor", id=id)[0]
 
     try:
-        response = requests.get(url, timeout=10)
+        response = upstream_get(url)
         result = response.json()
 
         # ❌ Wrong ID
@@ -961,16 +3992,15 @@ def check_arena_of_valor(request: Request, id: str, _: str = Depends(verify_api_
 # ------------------------------
 
 @app.get("/games/undawn")
-@limiter.limit("100/day")
-
+@game_lookup("undawn")
 def check_undawn(request: Request, id: str, _: str = Depends(verify_api_key)):
     """
     Check Undawn ID .
     """
-    url = f"https://c-node-amber.vercel.app/api/game/undawn?id={id}"
+    url = provider_urls("undawn", id=id)[0]
 
     try:
-        response = requests.get(url, timeout=10)
+        response = upstream_get(url)
         result = response.json()
 
         # ❌ Wrong ID
@@ -1003,15 +4033,15 @@ def check_undawn(request: Request, id: str, _: str = Depends(verify_api_key)):
 # ------------------------------
 
 @app.get("/games/sausage_man")
-@limiter.limit("100/day")
+@game_lookup("sausage_man")
 def check_sausage_man(request: Request, id: str, _: str = Depends(verify_api_key)):
     """
     Check Sausage Man ID.
     """
-    url = f"https://gameidcheckerenglish.vercel.app/api/game/sausage-man?id={id}"
+    url = provider_urls("sausage_man", id=id)[0]
 
     try:
-        response = requests.get(url, timeout=10)
+        response = upstream_get(url)
         result = response.json()
 
         # ❌ Wrong ID
@@ -1044,15 +4074,15 @@ def check_sausage_man(request: Request, id: str, _: str = Depends(verify_api_key
 # ------------------------------
 
 @app.get("/games/clash_of_clan")
-@limiter.limit("100/day")
+@game_lookup("clash_of_clan")
 def check_clash_of_clan(request: Request, id: str, _: str = Depends(verify_api_key)):
     """
     Check Clash of Clans ID.
     """
-    url = f"https://cek-id-game.vercel.app/api/game/clash-of-st?id={id}"
+    url = provider_urls("clash_of_clan", id=id)[0]
 
     try:
-        response = requests.get(url, timeout=10)
+        response = upstream_get(url)
         result = response.json()
 
         # ❌ Wrong ID
@@ -1092,16 +4122,16 @@ def check_clash_of_clan(request: Request, id: str, _: str = Depends(verify_api_k
 # ------------------------------
 
 @app.get("/games/clash_royale")
-@limiter.limit("100/day")
+@game_lookup("clash_royale")
 def check_clash_royale(request: Request, id: str, _: str = Depends(verify_api_key)):
 
     """
     Check Clash Royale ID.
     """
-    url = f"https://gameidcheckerenglish.vercel.app/api/game/clash-royale-st?id={id}"
+    url = provider_urls("clash_royale", id=id)[0]
 
     try:
-        response = requests.get(url, timeout=10)
+        response = upstream_get(url)
         result = response.json()
 
         # ❌ Wrong ID
@@ -1135,27 +4165,12 @@ def check_clash_royale(request: Request, id: str, _: str = Depends(verify_api_ke
             "data": {}
         }
 
-# ✅ Zone mapping for Genshin Impact
-GENSHIN_ZONES = {
-    "os_usa": "America",
-    "os_euro": "Europe",
-    "os_asia": "Asia",
-    "os_cht": "TW, HK, MO",
-    # allow shorthand too
-    "america": "America",
-    "europe": "Europe",
-    "asia": "Asia",
-    "tw": "TW, HK, MO",
-    "hk": "TW, HK, MO",
-    "mo": "TW, HK, MO",
-}
-
 # ------------------------------
 # Genshin Impact
 # ------------------------------
 
 @app.get("/games/genshin_impact")
-@limiter.limit("100/day")
+@game_lookup("genshin_impact")
 def check_genshin_impact(
     request: Request,
     id: str,
@@ -1165,39 +4180,32 @@ def check_genshin_impact(
     """
     Check Genshin Impact ID.
     """
-    
+    routing = ROUTING
+    zones = routing["zones"]["genshin_impact"]
 
-    zone_key = zone.lower()
     # Map shorthand to full zoneId
-    if zone_key in ["america", "usa", "na"]:
-        zone_id, zone_name = "os_usa", "America"
-    elif zone_key in ["europe", "eu"]:
-        zone_id, zone_name = "os_euro", "Europe"
-    elif zone_key in ["asia"]:
-        zone_id, zone_name = "os_asia", "Asia"
-    elif zone_key in ["tw", "hk", "mo", "cht", "tw_hk_mo"]:
-        zone_id, zone_name = "os_cht", "TW, HK, MO"
-    else:
+    zone_ids = zones["aliases"].get(zone.lower())
+    if not zone_ids:
         return {
             "code": 400,
             "status": False,
             "message": f"Invalid zone '{zone}'. Allowed: Asia, Europe, America, TW/HK/MO",
             "data": {}
         }
+    zone_id = zone_ids[0]
+    zone_name = zones["names"][zone_id]
 
-    urls = [
-        f"https://cek-id-game.vercel.app/api/game/genshin-impact-vc?id={id}&zone={zone_id}",
-        f"https://c-node-amber.vercel.app/api/game/genshin-impact?id={id}&zone={zone_id}",
-        f"https://gameopenworld.vercel.app/genshin?characterId={id}&serverId={zone_id}"
-    ]
+    urls = provider_urls("genshin_impact", routing, id=id, zone=zone_id)
+    affinity = provider_affinity("genshin_impact", id, zone)
 
-    for url in urls:
+    for url in prefer_provider(balance_urls(urls), affinity):
         try:
-            response = requests.get(url, timeout=10)
+            response = upstream_get(url)
             result = response.json()
 
             # ✅ First two APIs
             if result.get("status") is True and "data" in result:
+                remember_provider("genshin_impact", id, zone, url, zone_id)
                 return {
                     "code": 200,
                     "status": True,
@@ -1211,6 +4219,7 @@ def check_genshin_impact(
 
             # ✅ Third API
             if result.get("success") is True and "data" in result:
+                remember_provider("genshin_impact", id, zone, url, zone_id)
                 return {
                     "code": 200,
                     "status": True,
@@ -1238,32 +4247,18 @@ def check_genshin_impact(
 # ------------------------------
 
 @app.get("/games/honkai_star_rail")
-@limiter.limit("100/day")
+@game_lookup("honkai_star_rail")
 def check_honkai_star_rail(request: Request, id: str, zone: str, _: str = Depends(verify_api_key)):
     """
     Check Honkai: Star Rail ID.
     """
 
-    # ✅ Zone mappings (official IDs → display names)
-    zone_map = {
-        "prod_official_usa": "America",
-        "prod_official_asia": "Asia",
-        "prod_official_eur": "Europe",
-        "prod_official_cht": "TW,HK,MO",
-        "os_usa": "America",
-        "os_asia": "Asia",
-        "os_euro": "Europe",
-        "os_cht": "TW,HK,MO",
-    }
+    routing = ROUTING
+    zones = routing["zones"]["honkai_star_rail"]
 
-    # ✅ Accept user-friendly input → multiple possible API zones
-    user_zone_map = {
-        "america": ["prod_official_usa", "os_usa"],
-        "asia": ["prod_official_asia", "os_asia"],
-        "europe": ["prod_official_eur", "os_euro"],
-        "tw": ["prod_official_cht", "os_cht"],
-        "tw,hk,mo": ["prod_official_cht", "os_cht"],
-    }
+    # ✅ Official IDs → display names, user-friendly input → possible API zones
+    zone_map = zones["names"]
+    user_zone_map = zones["aliases"]
 
     zone_key = zone.lower()
     if zone_key not in user_zone_map:
@@ -1274,26 +4269,24 @@ def check_honkai_star_rail(request: Request, id: str, zone: str, _: str = Depend
             "data": {}
         }
 
-    # ✅ Try both official + os zones
-    possible_zone_ids = user_zone_map[zone_key]
+    # ✅ Try both official + os zones (the one that last worked for this ID first)
+    affinity = provider_affinity("honkai_star_rail", id, zone)
+    possible_zone_ids = prefer_zone(user_zone_map[zone_key], affinity)
 
     for zone_api in possible_zone_ids:
         zone_display = zone_map[zone_api]
 
         # ✅ APIs to try
-        urls = [
-            f"https://cek-id-game.vercel.app/api/game/honkai-star-rail?id={id}&zone={zone_api}",
-            f"https://gameopenworld.vercel.app/honkai-starrail?characterId={id}&serverId={zone_api}",
-            f"https://gameidcheckerenglish.vercel.app/api/game/honkai-star-rail?id={id}&zone={zone_api}"
-        ]
+        urls = provider_urls("honkai_star_rail", routing, id=id, zone=zone_api)
 
-        for url in urls:
+        for url in prefer_provider(balance_urls(urls), affinity):
             try:
-                response = requests.get(url, timeout=10)
+                response = upstream_get(url)
                 result = response.json()
 
                 # 🔹 API #1 (cek-id-game)
                 if "status" in result and result.get("status") is True and "data" in result:
+                    remember_provider("honkai_star_rail", id, zone, url, zone_api)
                     return {
                         "code": 200,
                         "status": True,
@@ -1307,6 +4300,7 @@ def check_honkai_star_rail(request: Request, id: str, zone: str, _: str = Depend
 
                 # 🔹 API #2 (gameopenworld)
                 if "success" in result and result.get("success") is True and "data" in result:
+                    remember_provider("honkai_star_rail", id, zone, url, zone_api)
                     return {
                         "code": 200,
                         "status": True,
@@ -1320,6 +4314,7 @@ def check_honkai_star_rail(request: Request, id: str, zone: str, _: str = Depend
 
                 # 🔹 API #3 (gameidcheckerenglish)
                 if "code" in result and result.get("code") == 200 and "data" in result:
+                    remember_provider("honkai_star_rail", id, zone, url, zone_api)
                     return {
                         "code": 200,
                         "status": True,
@@ -1347,32 +4342,18 @@ def check_honkai_star_rail(request: Request, id: str, zone: str, _: str = Depend
 # ------------------------------
 
 @app.get("/games/zenless_zone_zero")
-@limiter.limit("100/day")
+@game_lookup("zenless_zone_zero")
 def check_zenless_zone_zero(request: Request, id: str, zone: str, _: str = Depends(verify_api_key)):
     """
     Check Zenless Zone Zero ID .
     """
 
-    # ✅ Zone mappings (API zones → display names)
-    zone_map = {
-        "prod_gf_us": "America",
-        "prod_gf_jp": "Asia",
-        "prod_gf_eu": "Europe",
-        "prod_gf_sg": "TW,HK,MO",
-        "os_usa": "America",
-        "os_asia": "Asia",
-        "os_euro": "Europe",
-        "os_cht": "TW,HK,MO",
-    }
+    routing = ROUTING
+    zones = routing["zones"]["zenless_zone_zero"]
 
-    # ✅ Accept user-friendly input
-    user_zone_map = {
-        "america": ["prod_gf_us", "os_usa"],
-        "asia": ["prod_gf_jp", "os_asia"],
-        "europe": ["prod_gf_eu", "os_euro"],
-        "tw": ["prod_gf_sg", "os_cht"],
-        "tw,hk,mo": ["prod_gf_sg", "os_cht"],
-    }
+    # ✅ API zones → display names, user-friendly input → API zones
+    zone_map = zones["names"]
+    user_zone_map = zones["aliases"]
 
     zone_key = zone.lower()
     if zone_key not in user_zone_map:
@@ -1391,23 +4372,23 @@ def check_zenless_zone_zero(request: Request, id: str, zone: str, _: str = Depen
     # Display zone name
     zone_display = zone_map[primary_zone]
 
-    # ✅ APIs to try
+    # ✅ APIs to try; gameopenworld ({alt_zone}) needs the os_* format
+    has_os_zone = bool(alt_zone and alt_zone.startswith("os_"))
     urls = [
-        f"https://cek-id-game.vercel.app/api/game/zenless-zone-zero?id={id}&zone={primary_zone}",
-        f"https://gameidcheckerenglish.vercel.app/api/game/zenless-zone-zero?id={id}&zone={primary_zone}",
+        template.format(id=id, zone=primary_zone, alt_zone=alt_zone)
+        for template in routing["providers"]["zenless_zone_zero"]
+        if has_os_zone or "{alt_zone}" not in template
     ]
+    affinity = provider_affinity("zenless_zone_zero", id, zone)
 
-    # Add gameopenworld (needs os_* format)
-    if alt_zone and alt_zone.startswith("os_"):
-        urls.append(f"https://gameopenworld.vercel.app/zzz?characterId={id}&serverId={alt_zone}")
-
-    for url in urls:
+    for url in prefer_provider(balance_urls(urls), affinity):
         try:
-            response = requests.get(url, timeout=10)
+            response = upstream_get(url)
             result = response.json()
 
             # 🔹 API #1 & #2 (cek-id-game + gameidcheckerenglish)
             if "status" in result and result.get("status") is True and "data" in result:
+                remember_provider("zenless_zone_zero", id, zone, url, primary_zone)
                 return {
                     "code": 200,
                     "status": True,
@@ -1421,6 +4402,7 @@ def check_zenless_zone_zero(request: Request, id: str, zone: str, _: str = Depen
 
             # 🔹 API #3 (gameopenworld)
             if "success" in result and result.get("success") is True and "data" in result:
+                remember_provider("zenless_zone_zero", id, zone, url, alt_zone)
                 return {
                     "code": 200,
                     "status": True,
@@ -1448,29 +4430,18 @@ def check_zenless_zone_zero(request: Request, id: str, zone: str, _: str = Depen
 # ------------------------------
 
 @app.get("/games/wuthering_waves")
-@limiter.limit("100/day")
+@game_lookup("wuthering_waves")
 def check_wuthering_waves(request: Request, id: str, zone: str, _: str = Depends(verify_api_key)):
     """
     Check Wuthering Waves ID .
     """
 
-    # ✅ Zone mappings
-    zone_map = {
-        "os_usa": "America",
-        "os_euro": "Europe",
-        "os_asia": "Asia",
-        "os_sea": "SEA",
-        "os_cht": "HMT",
-    }
+    routing = ROUTING
+    zones = routing["zones"]["wuthering_waves"]
 
-    # ✅ Accept user-friendly input
-    user_zone_map = {
-        "america": "os_usa",
-        "europe": "os_euro",
-        "asia": "os_asia",
-        "sea": "os_sea",
-        "hmt": "os_cht",
-    }
+    # ✅ Zone mappings + user-friendly input
+    zone_map = zones["names"]
+    user_zone_map = zones["aliases"]
 
     zone_key = zone.lower()
     if zone_key not in user_zone_map:
@@ -1482,14 +4453,14 @@ def check_wuthering_waves(request: Request, id: str, zone: str, _: str = Depends
         }
 
     # API-compatible zone
-    zone_api = user_zone_map[zone_key]
+    zone_api = user_zone_map[zone_key][0]
     zone_display = zone_map[zone_api]
 
     # ✅ API call
-    url = f"https://gameopenworld.vercel.app/wuthering?characterId={id}&serverId={zone_api}"
+    url = provider_urls("wuthering_waves", routing, id=id, zone=zone_api)[0]
 
     try:
-        response = requests.get(url, timeout=10)
+        response = upstream_get(url)
         result = response.json()
 
         if "success" in result and result.get("success") is True and "data" in result:
@@ -1515,4 +4486,252 @@ def check_wuthering_waves(request: Request, id: str, zone: str, _: str = Depends
         "data": {}
     }
 
+# ------------------------------
+# Cross-game discovery (zone-less games)
+# ------------------------------
+
+DISCOVER_DEADLINE = float(os.getenv("DISCOVER_DEADLINE", "8"))
+discover_pool = ThreadPoolExecutor(max_workers=int(os.getenv("DISCOVER_WORKERS", "16")))
+
+
+@app.get("/games/discover")
+def discover_games(request: Request, id: str, _: str = Depends(verify_api_key)):
+    """
+    Find every zone-less game where the ID resolves.
+    """
+    if rate_limiter:
+        retry_after = rate_limiter.acquire(_, GAME_COSTS["discover"])
+        if retry_after:
+            if usage:
+                usage.record(_, "discover", "rate_limited", False, 0, 0.0)
+            return rate_limited_response("discover", request, retry_after)
+
+    # Only probe games whose ID format this ID can match
+    games = [
+        game for game, lookup in GAME_LOOKUPS.items()
+        if not lookup.accepts_zone and validate_lookup(game, id) is None
+    ]
+
+    futures = {
+        discover_pool.submit(contextvars.copy_context().run, run_lookup, game, id, None, _): game
+        for game in games
+    }
+    done, not_done = wait(futures, timeout=DISCOVER_DEADLINE)
+    # Probes still queued are dropped so stale work never piles up in discover_pool
+    for future in not_done:
+        future.cancel()
+
+    found = []
+    for future in done:
+        try:
+            result = future.result()
+        except Exception:
+            continue
+        if lookup_outcome(result) == "found":
+            found.append({"game": futures[future], "data": result.get("data", {})})
+
+    # Probes already running finish and fill the cache for the next call
+    pending = sorted(futures[future] for future in not_done)
+    found.sort(key=lambda item: games.index(item["game"]))
+
+    if not found:
+        return negotiated_response(
+            request, format_response(False, "ID not found in any game", {"user_id": id, "games": [], "pending": pending}, 404)
+        )
+
+    return negotiated_response(request, format_response(
+        True,
+        f"ID found in {len(found)} game(s)",
+        {"user_id": id, "games": found, "pending": pending},
+        200
+    ))
+
+# ------------------------------
+# On-demand profiling (admin)
+# ------------------------------
+
+profile_lock = threading.Lock()
+
+
+def threadpool_report() -> dict:
+    """Occupancy of the request thread pool (call from the event loop) and the discovery pool."""
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    return {
+        "request_pool": {"busy": limiter.borrowed_tokens, "size": limiter.total_tokens, "waiting": limiter.statistics().tasks_waiting},
+        "discover_pool": {"threads": len(discover_pool._threads), "queued": discover_pool._work_queue.qsize()},
+    }
+
+
+def frame_stack(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def sample_stacks(stop: threading.Event, interval: float, stacks: dict):
+    """Collect collapsed stacks of every other thread until stopped."""
+    me = threading.get_ident()
+    while not stop.wait(interval):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            key = f"{names.get(ident, ident)};{frame_stack(frame)}"
+            stacks[key] = stacks.get(key, 0) + 1
+
+
+@app.get("/admin/profile")
+async def profile(
+    request: Request,
+    seconds: float = Query(5, gt=0, le=60),
+    interval_ms: float = Query(5, ge=1, le=1000),
+    format: str = Query("json", pattern="^(json|collapsed)$"),
+    memory: bool = True,
+    top: int = Query(25, ge=1, le=500),
+    _: str = Depends(verify_admin_key)
+):
+    """
+    Sample all thread stacks for N seconds (collapsed / flame-graph format), with tracemalloc top allocation sites and thread-pool occupancy.
+    """
+    if not profile_lock.acquire(blocking=False):
+        return JSONResponse(status_code=409, content=format_response(False, "A profile is already running", {}, 409))
+
+    try:
+        started_tracing = memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+
+        stacks, stop = {}, threading.Event()
+        sampler = threading.Thread(target=sample_stacks, args=(stop, interval_ms / 1000, stacks), name="profiler", daemon=True)
+        sampler.start()
+        await asyncio.sleep(seconds)
+        pool = threadpool_report()
+        stop.set()
+        sampler.join()
+
+        allocations = []
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            for stat in snapshot.statistics("lineno")[:top]:
+                frame = stat.traceback[0]
+                allocations.append({"site": f"{frame.filename}:{frame.lineno}", "size_kb": round(stat.size / 1024, 1), "count": stat.count})
+            if started_tracing:
+                tracemalloc.stop()
+    finally:
+        profile_lock.release()
+
+    ranked = sorted(stacks.items(), key=lambda item: item[1], reverse=True)
+    if format == "collapsed":
+        return PlainTextResponse("".join(f"{stack} {count}\n" for stack, count in ranked))
+
+    return negotiated_response(request, format_response(True, f"Profiled {seconds}s", {
+        "samples": sum(stacks.values()),
+        "stacks": [{"stack": stack, "count": count} for stack, count in ranked[:top]],
+        "allocations": allocations,
+        "thread_pools": pool,
+    }))
+
+
+# ------------------------------
+# WebSocket lookups (multiplexed)
+# ------------------------------
+
+WS_MAX_IN_FLIGHT = int(os.getenv("WS_MAX_IN_FLIGHT", "8"))
+
+
+@app.websocket("/ws")
+async def lookup_ws(websocket: WebSocket):
+    """
+    Authenticate once, then send {"req_id", "game", "id", "zone"} messages
+    and receive {"req_id", ...response} as each lookup completes.
+    {"type": "cancel", "req_id"} drops a pending lookup; reusing a req_id
+    that is still pending replaces it.
+    """
+    api_key = websocket.query_params.get("api_key") or websocket.headers.get("x-api-key")
+    if api_key_error(api_key, websocket.client.host):
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    pending = {}        # req_id -> abandon Event of the lookup the client still wants
+    running = set()     # lookups whose thread has not returned yet, abandoned ones included
+    send_lock = asyncio.Lock()
+
+    async def send(req_id, payload):
+        async with send_lock:
+            await websocket.send_json({"req_id": req_id, **payload})
+
+    async def lookup(req_id, game, id, zone, abandon):
+        # A cancelled lookup's thread starts no new upstream attempts (see ensure_client_connected)
+        current_disconnect.set(abandon)
+        try:
+            result = await run_in_threadpool(run_lookup, game, id, zone, api_key)
+        except Exception as e:
+            result = format_response(False, str(e), {}, 500)
+        finally:
+            running.discard(asyncio.current_task())
+            if pending.get(req_id) is abandon:
+                del pending[req_id]
+        if not abandon.is_set():
+            await send(req_id, result)
+
+    try:
+        while True:
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            try:
+                # text or binary frames, both holding a UTF-8 JSON object
+                message = json.loads(frame["text"] if frame.get("text") is not None else frame.get("bytes") or b"")
+            except ValueError:
+                await send(None, format_response(False, "Invalid JSON message", {}, 400))
+                continue
+            if not isinstance(message, dict):
+                await send(None, format_response(False, "Message must be a JSON object", {}, 400))
+                continue
+
+            req_id = message.get("req_id")
+            if req_id is not None and not isinstance(req_id, (str, int)):
+                await send(None, format_response(False, "req_id must be a string or an integer", {}, 400))
+                continue
+            if req_id in pending:
+                pending.pop(req_id).set()
+            if message.get("type") == "cancel":
+                continue
+
+            game, id, zone = message.get("game"), message.get("id"), message.get("zone")
+            if not all(value is None or isinstance(value, (str, int)) for value in (game, id, zone)):
+                await send(req_id, format_response(False, "game, id and zone must be strings or integers", {}, 400))
+                continue
+            if game not in GAME_LOOKUPS:
+                await send(req_id, format_response(False, f"Unknown game '{game}'", {}, 404))
+                continue
+            if not id or (GAME_LOOKUPS[game].needs_zone and not zone):
+                await send(req_id, format_response(False, "Missing id or zone", {}, 400))
+                continue
+            # Cancelled lookups count until their thread returns
+            if len(running) >= WS_MAX_IN_FLIGHT:
+                await send(req_id, format_response(False, f"Too many in-flight lookups (max {WS_MAX_IN_FLIGHT})", {}, 429))
+                continue
+            if rate_limiter and game not in RATE_EXEMPT_GAMES:
+                retry_after = rate_limiter.acquire(api_key, GAME_COSTS.get(game, 1))
+                if retry_after:
+                    if usage:
+                        usage.record(api_key, game, "rate_limited", False, 0, 0.0)
+                    await send(req_id, format_response(False, "Rate limit exceeded", {"retry_after": math.ceil(retry_after)}, 429))
+                    continue
+
+            abandon = pending[req_id] = threading.Event()
+            running.add(asyncio.create_task(lookup(req_id, game, str(id), zone and str(zone), abandon)))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # Same accounting as DisconnectWatchMiddleware: one per lookup left unanswered
+        abandoned["disconnects"] += len(pending)
+        for abandon in pending.values():
+            abandon.set()
+
 # Add more routes and logic as needed for your application.
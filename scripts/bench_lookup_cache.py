@@ -0,0 +1,91 @@
+"""
+Memory and throughput of the lookup cache storage backends.
+
+Fills the cache with realistic lookup envelopes (MLBB-style username /
+user_id / zone), then reports bytes per entry and get/set throughput.
+The compact backend's bytes come from its own accounting (arena + slot
+arrays); both backends also report the traced allocation delta.
+
+    python scripts/bench_lookup_cache.py                          # 1M and 10M, compact only
+    python scripts/bench_lookup_cache.py --sizes 1000000 --dict   # include the dict backend
+"""
+import argparse
+import gc
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ["WARMUP_ENABLED"] = "0"
+
+from api.main import CompactLookupCache, LookupCache  # noqa: E402
+
+ZONES = ["America", "Asia", "Europe", "TW,HK,MO", "Indonesia", "Philippines", "Brazil", "Russia"]
+GAMES = ["ml_ign", "genshin_impact", "honkai_star_rail", "bgmi", "free_fire"]
+
+
+def envelope(rng, i):
+    username = "".join(rng.choices(string.ascii_letters + string.digits, k=rng.randint(6, 16)))
+    return {
+        "code": 200,
+        "status": True,
+        "message": "ID Successfully Found",
+        "data": {"username": username, "user_id": str(100000000 + i), "zone": rng.choice(ZONES)},
+    }
+
+
+def lookup_key(i):
+    return GAMES[i % len(GAMES)], str(100000000 + i), str(1000 + i % 3000)
+
+
+def bench(cache, size, reads, trace):
+    rng = random.Random(42)
+    gc.collect()
+    if trace:
+        tracemalloc.start()
+    started = time.perf_counter()
+    for i in range(size):
+        cache.set(lookup_key(i), envelope(rng, i), 3600)
+    set_rate = size / (time.perf_counter() - started)
+    traced = tracemalloc.get_traced_memory()[0] if trace else None
+    if trace:
+        tracemalloc.stop()
+
+    keys = [lookup_key(rng.randrange(size)) for _ in range(reads)]
+    started = time.perf_counter()
+    hits = sum(cache.get(key) is not None for key in keys)
+    get_rate = reads / (time.perf_counter() - started)
+    return set_rate, get_rate, hits, traced
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000_000, 10_000_000])
+    parser.add_argument("--reads", type=int, default=200_000)
+    parser.add_argument("--dict", action="store_true", help="also measure the OrderedDict backend")
+    parser.add_argument("--trace", action="store_true", help="measure allocations with tracemalloc (slow)")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        backends = [("compact", CompactLookupCache(size, 2 ** 31 - 1))]
+        if args.dict:
+            backends.append(("dict", LookupCache(size)))
+
+        for name, cache in backends:
+            set_rate, get_rate, hits, traced = bench(cache, size, args.reads, args.trace)
+            line = f"{name:8} {size:>11,} entries  set {set_rate:>10,.0f}/s  get {get_rate:>10,.0f}/s  hits {hits}/{args.reads}"
+            if isinstance(cache, CompactLookupCache):
+                report = cache.memory_report()
+                line += f"  {report['bytes_per_entry']} B/entry (records {report['record_bytes'] / size:.1f} B)"
+            if traced is not None:
+                line += f"  traced {traced / size:.1f} B/entry"
+            print(line, flush=True)
+            del cache
+            gc.collect()
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,130 @@
+"""
+Benchmark the native GCRA limiter (api/main.py) against slowapi.
+
+Two measurements:
+  decision   one limiter check per call, in a tight loop
+  request    full ASGI requests through a minimal app for a limited lookup
+             route and an exempt /health route, one app per limiter
+
+    python scripts/bench_rate_limit.py
+    python scripts/bench_rate_limit.py --decisions 500000 --requests 5000 --keys 1000
+
+slowapi is only needed here: pip install -r requirements-dev.txt
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ["WARMUP_ENABLED"] = "0"
+
+from fastapi import FastAPI, Request  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from limits import parse  # noqa: E402
+from limits.storage import MemoryStorage  # noqa: E402
+from limits.strategies import FixedWindowRateLimiter  # noqa: E402
+from slowapi import Limiter  # noqa: E402
+from slowapi.middleware import SlowAPIMiddleware  # noqa: E402
+
+from api.main import GcraLimiter  # noqa: E402
+
+# Generous enough that nothing is rejected: we time the bookkeeping, not 429s
+BENCH_TIERS = {"bench": {"per_second": 1e9, "burst": 1e9, "daily": 1e12}}
+SLOWAPI_LIMIT = "1000000000/day"
+
+
+def per_call_us(fn, count):
+    started = time.perf_counter()
+    for i in range(count):
+        fn(i)
+    return (time.perf_counter() - started) / count * 1e6
+
+
+def bench_decisions(count, keys):
+    gcra = GcraLimiter(BENCH_TIERS, {}, "bench")
+    window = FixedWindowRateLimiter(MemoryStorage())
+    item = parse(SLOWAPI_LIMIT)
+    return {
+        "gcra": per_call_us(lambda i: gcra.acquire(f"key-{i % keys}"), count),
+        "slowapi (limits fixed-window)": per_call_us(lambda i: window.hit(item, f"key-{i % keys}"), count),
+    }
+
+
+def slowapi_app():
+    app = FastAPI()
+    limiter = Limiter(key_func=lambda request: request.query_params.get("api_key"))
+    app.state.limiter = limiter
+    app.add_middleware(SlowAPIMiddleware)
+
+    @app.get("/lookup")
+    @limiter.limit(SLOWAPI_LIMIT)
+    def lookup(request: Request, api_key: str):
+        return {"status": True}
+
+    @app.get("/health")
+    def health():
+        return {"status": "healthy"}
+
+    return app
+
+
+def gcra_app():
+    app = FastAPI()
+    limiter = GcraLimiter(BENCH_TIERS, {}, "bench")
+
+    @app.get("/lookup")
+    def lookup(request: Request, api_key: str):
+        if limiter.acquire(api_key):
+            return {"status": False}
+        return {"status": True}
+
+    @app.get("/health")
+    def health():
+        return {"status": "healthy"}
+
+    return app
+
+
+def plain_app():
+    app = FastAPI()
+
+    @app.get("/lookup")
+    def lookup(request: Request, api_key: str):
+        return {"status": True}
+
+    @app.get("/health")
+    def health():
+        return {"status": "healthy"}
+
+    return app
+
+
+def bench_requests(count, keys):
+    results = {}
+    for name, factory in (("no limiter", plain_app), ("gcra", gcra_app), ("slowapi", slowapi_app)):
+        with TestClient(factory()) as client:
+            for path in ("/lookup", "/health"):
+                client.get(f"{path}?api_key=warmup")
+                results[(name, path)] = per_call_us(lambda i: client.get(f"{path}?api_key=key-{i % keys}"), count)
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--decisions", type=int, default=200000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--keys", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"limiter decision ({args.decisions} calls, {args.keys} keys)")
+    for name, us in bench_decisions(args.decisions, args.keys).items():
+        print(f"  {name:32} {us:8.2f} us/call")
+
+    print(f"\nASGI request ({args.requests} requests per route)")
+    for (name, path), us in bench_requests(args.requests, args.keys).items():
+        print(f"  {name:12} {path:10} {us:8.1f} us/request")
+
+
+if __name__ == "__main__":
+    main_cli()
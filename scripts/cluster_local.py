@@ -0,0 +1,65 @@
+"""
+Run a local cache cluster: N uvicorn processes of api/main.py sharing
+their lookup cache over a consistent-hash ring (see CLUSTER_* in main.py).
+
+    python scripts/cluster_local.py --nodes 3                 # ports 8001..8003
+    python scripts/cluster_local.py --nodes 3 --replicas 1 --base-port 9001
+
+Every node gets the same CLUSTER_NODES / CLUSTER_SECRET and its own
+CLUSTER_SELF; Ctrl+C stops them all. /admin/cluster (with ADMIN_API_KEY)
+and /metrics show peer hits, misses and replication per node.
+"""
+import argparse
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--base-port", type=int, default=8001)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--replicas", type=int, default=2)
+    parser.add_argument("--vnodes", type=int, default=128)
+    args = parser.parse_args()
+
+    urls = [f"http://{args.host}:{args.base_port + i}" for i in range(args.nodes)]
+    shared = {
+        "CLUSTER_NODES": ",".join(urls),
+        "CLUSTER_SECRET": os.getenv("CLUSTER_SECRET") or secrets.token_hex(16),
+        "CLUSTER_REPLICAS": str(args.replicas),
+        "CLUSTER_VNODES": str(args.vnodes),
+    }
+
+    processes = []
+    for i, url in enumerate(urls):
+        env = {**os.environ, **shared, "CLUSTER_SELF": url}
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "api.main:app", "--host", args.host, "--port", str(args.base_port + i)],
+            cwd=ROOT, env=env,
+        ))
+        print(f"node {i + 1}: {url} (pid {processes[-1].pid})")
+
+    try:
+        while all(process.poll() is None for process in processes):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in processes:
+            process.wait()
+
+    sys.exit(max(process.returncode or 0 for process in processes))
+
+
+if __name__ == "__main__":
+    main_cli()
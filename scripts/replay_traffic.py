@@ -0,0 +1,176 @@
+"""
+Offline replay of traffic recorded with CAPTURE_PATH.
+
+Runs every captured request against the current build of api/main.py with
+all upstream calls answered from the recording (at the recorded latency),
+then reports throughput, latency percentiles and response-body diffs.
+
+    CAPTURE_PATH=capture.jsonl uvicorn api.main:app      # record
+    python scripts/replay_traffic.py capture.jsonl        # replay
+    python scripts/replay_traffic.py capture.jsonl --concurrency 16 --speed 0
+
+Replay always tries providers in list order (LB_MODE=off, no affinity). A
+recording taken with load balancing on may have skipped some of those calls;
+they count as unmatched (answered as connection errors) the same way on
+every run. Record with LB_MODE=off for a capture that replays with none.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# No warm-up traffic, rate limiting, logging or re-capture while replaying
+os.environ["WARMUP_ENABLED"] = "0"
+os.environ["RATE_LIMIT"] = "off"
+for name in ("CAPTURE_PATH", "ACCESS_LOG_PATH", "USAGE_PATH", "CLUSTER_NODES", "SHARED_CACHE_PATH", "FAULT_INJECTION"):
+    os.environ.pop(name, None)
+
+# Providers are tried in list order with no state carried between requests, so
+# replay hits the same recorded upstream calls on every run
+os.environ["LB_MODE"] = "off"
+os.environ["AFFINITY"] = "0"
+os.environ["NEGATIVE_FILTER"] = "0"
+os.environ["THROTTLE"] = "0"
+
+import requests  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+import api.main as main  # noqa: E402
+
+REPLAY_KEY = "replay-key"
+
+# Smile.One signs every call with the current time, so these never match
+VOLATILE_FIELDS = {"time", "sign"}
+
+
+def upstream_key(method, url, data):
+    fields = tuple(sorted((k, str(v)) for k, v in (data or {}).items() if k not in VOLATILE_FIELDS))
+    return method.upper(), url, fields
+
+
+class RecordedResponse:
+    """Just enough of requests.Response for the handlers."""
+
+    def __init__(self, entry):
+        self.status_code = entry["status"]
+        self.text = entry["body"] or ""
+        self.content = self.text.encode()
+        self.headers = requests.structures.CaseInsensitiveDict(
+            {"Content-Type": entry.get("content_type") or "application/json"}
+        )
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} (recorded)", response=self)
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class RecordedUpstream:
+    """Replaces upstream_session.request, answering from the capture file."""
+
+    def __init__(self, records, speed):
+        self.speed = speed
+        self.responses = {}
+        self.unmatched = 0
+        self.lock = threading.Lock()
+        for record in records:
+            for entry in record["upstream"]:
+                key = upstream_key(entry["method"], entry["url"], entry["data"])
+                self.responses.setdefault(key, entry)
+
+    def request(self, method, url, data=None, **kwargs):
+        entry = self.responses.get(upstream_key(method, url, data))
+        if entry is None:
+            with self.lock:
+                self.unmatched += 1
+            raise requests.exceptions.ConnectionError(f"No recorded response for {method} {url}")
+
+        if self.speed:
+            time.sleep(entry["elapsed_ms"] / 1000 * self.speed)
+        if entry["error"]:
+            raise requests.exceptions.ConnectionError(entry["error"])
+        return RecordedResponse(entry)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def load_records(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay(records, concurrency, speed, show_diffs):
+    upstream = RecordedUpstream(records, speed)
+    main.upstream_session.request = upstream.request
+    main.VALID_API_KEYS[REPLAY_KEY] = "testclient"
+
+    latencies = []
+    diffs = []
+
+    with TestClient(main.app) as client:
+        def run(record):
+            query = urlencode({**record["params"], "api_key": REPLAY_KEY})
+            started = time.monotonic()
+            response = client.get(f"{record['route']}?{query}")
+            latencies.append((time.monotonic() - started) * 1000)
+
+            if response.status_code != record["status"] or response.text != record["body"]:
+                diffs.append({
+                    "route": record["route"],
+                    "params": record["params"],
+                    "recorded": (record["status"], record["body"]),
+                    "replayed": (response.status_code, response.text),
+                })
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(run, records))
+        wall = time.monotonic() - started
+
+    recorded = [record["duration_ms"] for record in records]
+    print(f"requests:          {len(records)}")
+    print(f"throughput:        {len(records) / wall:.1f} req/s (concurrency {concurrency}, speed {speed})")
+    for pct in (50, 90, 99):
+        print(f"p{pct:<3} latency:      {percentile(latencies, pct):8.1f} ms  (recorded {percentile(recorded, pct):8.1f} ms)")
+    print(f"max latency:       {max(latencies, default=0):8.1f} ms")
+    print(f"unmatched upstream calls: {upstream.unmatched}")
+    print(f"body diffs:        {len(diffs)}")
+    for diff in diffs[:show_diffs]:
+        print(json.dumps(diff, ensure_ascii=False))
+
+    return 1 if diffs else 0
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="JSON-lines file written with CAPTURE_PATH")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--speed", type=float, default=1.0, help="upstream latency multiplier (0 = no delay)")
+    parser.add_argument("--show-diffs", type=int, default=10)
+    args = parser.parse_args()
+
+    sys.exit(replay(load_records(args.capture), args.concurrency, args.speed, args.show_diffs))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,11 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# Importing api.main must not start background work or touch real providers
+os.environ.setdefault("WARMUP_ENABLED", "0")
+os.environ.pop("SHARED_CACHE_PATH", None)
+os.environ.pop("ACCESS_LOG_PATH", None)
+os.environ.pop("CAPTURE_PATH", None)
+os.environ.pop("USAGE_PATH", None)
@@ -0,0 +1,164 @@
+import random
+import string
+
+from api.main import CompactLookupCache, StringTable
+
+
+def random_value(rng, depth=0):
+    kind = rng.randrange(9 if depth < 3 else 6)
+    if kind == 0:
+        return None
+    if kind == 1:
+        return rng.choice([True, False])
+    if kind == 2:
+        return rng.choice([0, -1, 1, 2 ** 63 - 1, -2 ** 63, rng.randrange(-10 ** 12, 10 ** 12)])
+    if kind == 3:
+        return rng.choice([0.0, -2.5, 1e300, rng.random()])
+    if kind == 4:
+        return "".join(rng.choice(string.ascii_letters + "éü名前 ") for _ in range(rng.randrange(20)))
+    if kind == 5:
+        return "x" * rng.choice([255, 256, 1000])
+    if kind == 6:
+        return [random_value(rng, depth + 1) for _ in range(rng.randrange(4))]
+    fields = ["username", "user_id", "zone", "message", "region", f"f{rng.randrange(50)}"]
+    return {rng.choice(fields): random_value(rng, depth + 1) for _ in range(rng.randrange(5))}
+
+
+def lookup(user_id, zone="asia", username="player"):
+    return {
+        "code": 200,
+        "status": True,
+        "message": "ID Successfully Found",
+        "data": {"username": username, "user_id": user_id, "zone": zone},
+    }
+
+
+def test_round_trip_matches_dict():
+    rng = random.Random(7)
+    cache = CompactLookupCache(10000, 64 * 1024 * 1024)
+    expected = {}
+    for n in range(3000):
+        key = (rng.choice(["bgmi", "ml_ign", "genshin_impact"]), str(rng.randrange(2000)), rng.choice([None, "1", "asia"]))
+        value = random_value(rng)
+        cache.set(key, value, 300)
+        expected[key] = value
+    for key, value in expected.items():
+        assert cache.get(key) == value
+    assert cache.count == len(expected)
+
+
+def test_unsupported_values_are_not_cached():
+    cache = CompactLookupCache(100, 1024 * 1024)
+    cache.set(("bgmi", "1", None), {"data": {1, 2}}, 300)
+    cache.set(("bgmi", "2", None), {1: "non-string field"}, 300)
+    cache.set(("bgmi", "3", None), {"big": 2 ** 64}, 300)
+    assert cache.get(("bgmi", "1", None)) is None
+    assert cache.get(("bgmi", "2", None)) is None
+    assert cache.get(("bgmi", "3", None)) is None
+    assert cache.count == 0
+
+
+def test_string_table_full_falls_back_to_inline_strings():
+    cache = CompactLookupCache(100, 1024 * 1024)
+    cache.strings = StringTable()
+    for field in ("code", "status", "message", "data", "username", "user_id", "zone", "bgmi"):
+        cache.strings.id(field)
+    cache.strings.MAX = len(cache.strings.strings)
+
+    cache.set(("bgmi", "1", None), lookup("1", zone="never-interned"), 300)
+    assert cache.get(("bgmi", "1", None)) == lookup("1", zone="never-interned")
+    # a field name that cannot be interned makes the result uncacheable
+    cache.set(("bgmi", "2", None), {"unknown": 1}, 300)
+    assert cache.get(("bgmi", "2", None)) is None
+
+
+def test_expired_entries_are_dropped():
+    cache = CompactLookupCache(100, 1024 * 1024)
+    cache.set(("bgmi", "1", None), lookup("1"), 1)
+    cache.set(("bgmi", "2", None), lookup("2"), 60)
+    cache._epoch -= 5
+    assert cache.get(("bgmi", "1", None)) is None
+    assert cache.get(("bgmi", "2", None)) == lookup("2")
+    assert cache.count == 1
+
+
+def test_entry_limit_keeps_recently_read_entries():
+    cache = CompactLookupCache(100, 64 * 1024 * 1024)
+    for n in range(101):
+        cache.set(("bgmi", str(n), None), lookup(str(n)), 300)
+    assert cache.count == 100
+
+    read = [n for n in range(50) if cache.get(("bgmi", str(n), None)) is not None]
+    for n in range(1000, 1040):
+        cache.set(("bgmi", str(n), None), lookup(str(n)), 300)
+
+    assert cache.count == 100
+    assert all(cache.get(("bgmi", str(n), None)) == lookup(str(n)) for n in read)
+    assert all(cache.get(("bgmi", str(n), None)) == lookup(str(n)) for n in range(1000, 1040))
+
+
+def test_byte_budget_is_never_exceeded():
+    cache = CompactLookupCache(100000, 4096)
+    for n in range(500):
+        cache.set(("bgmi", str(n), None), lookup(str(n), username="u" * (n % 200)), 300)
+        assert cache.live_bytes <= cache.max_bytes
+        assert cache.get(("bgmi", str(n), None)) == lookup(str(n), username="u" * (n % 200))
+    assert cache.count < 500
+
+    cache.set(("bgmi", "huge", None), lookup("huge", username="u" * 5000), 300)
+    assert cache.get(("bgmi", "huge", None)) is None
+
+
+def test_rehash_clears_tombstones_and_keeps_entries():
+    cache = CompactLookupCache(50, 64 * 1024 * 1024)
+    for n in range(5000):
+        cache.set(("bgmi", str(n), None), lookup(str(n)), 300)
+        assert cache.count + cache.deleted <= cache.capacity * 0.85
+    assert cache.count == 50
+
+    live = {n for n in range(5000) if cache.get(("bgmi", str(n), None)) is not None}
+    assert len(live) == 50
+    cache._rehash()
+    assert cache.deleted == 0
+    assert all(cache.get(("bgmi", str(n), None)) == lookup(str(n)) for n in live)
+
+
+def test_compaction_reclaims_overwritten_records():
+    cache = CompactLookupCache(1000, 64 * 1024 * 1024)
+    for generation in range(40):
+        for n in range(100):
+            cache.set(("bgmi", str(n), None), lookup(str(n), username=f"{generation}-" + "u" * 400), 300)
+        # garbage is compacted once it exceeds both the live bytes and 1 MB
+        assert cache.garbage_bytes <= max(cache.live_bytes, 1024 * 1024) + 1000
+        assert len(cache._arena) == cache.live_bytes + cache.garbage_bytes
+
+    assert cache.count == 100
+    for n in range(100):
+        assert cache.get(("bgmi", str(n), None)) == lookup(str(n), username="39-" + "u" * 400)
+
+
+def test_caller_supplied_zones_are_not_interned():
+    cache = CompactLookupCache(1000, 64 * 1024 * 1024)
+    for n in range(100):
+        cache.set(("ml_ign", str(n), str(n)), lookup(str(n), zone=f"zone-{n}"), 300)
+    assert not any(s.startswith("zone-") for s in cache.strings.strings)
+    assert all(cache.get(("ml_ign", str(n), str(n))) == lookup(str(n), zone=f"zone-{n}") for n in range(100))
+
+
+def test_distinct_messages_cannot_fill_the_string_table():
+    cache = CompactLookupCache(100000, 64 * 1024 * 1024)
+    for n in range(10000):
+        cache.set(("bgmi", str(n), None), {**lookup(str(n)), "message": f"message {n}"}, 300)
+    assert len(cache.strings.strings) < cache.strings.MAX
+
+    cache.set(("bgmi", "new", None), {"new_field": 1}, 300)
+    assert cache.get(("bgmi", "new", None)) == {"new_field": 1}
+    assert cache.get(("bgmi", "9999", None)) == {**lookup("9999"), "message": "message 9999"}
+
+
+def test_byte_budget_includes_interned_strings():
+    cache = CompactLookupCache(100000, 64 * 1024)
+    for n in range(2000):
+        cache.set(("bgmi", str(n), None), {**lookup(str(n)), "message": f"message {n}"}, 300)
+        assert cache.live_bytes + cache.strings.bytes <= cache.max_bytes
+    assert cache.strings.bytes == sum(len(s.encode()) for s in cache.strings.strings)
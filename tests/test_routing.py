@@ -0,0 +1,51 @@
+import copy
+import json
+
+import pytest
+
+from api.main import ROUTING_CONFIG, compile_routing
+
+
+@pytest.fixture
+def raw():
+    with open(ROUTING_CONFIG, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_shipped_config_compiles(raw):
+    routing = compile_routing(raw)
+    assert routing["zones"]["genshin_impact"]["aliases"]["asia"]
+
+
+@pytest.mark.parametrize("break_config", [
+    lambda raw: raw["providers"].pop("bgmi"),
+    lambda raw: raw["zones"].pop("honkai_star_rail"),
+    lambda raw: raw["smile_one"].pop("ml_role_php"),
+    lambda raw: raw["zones"]["genshin_impact"].pop("aliases"),
+    lambda raw: raw["zones"]["wuthering_waves"]["aliases"].update(asia="os_asia"),
+    lambda raw: raw["providers"]["bgmi"].append("https://example.com/?id={id}&zone={zone}"),
+    lambda raw: raw["providers"]["ml_ign"].append("https://example.com/?id={id}&zone={alt_zone}"),
+    lambda raw: raw["providers"].update(undawn="https://example.com/?id={id}"),
+    lambda raw: raw["providers"]["bgmi"].append("https://example.com/?id={id"),
+    lambda raw: raw.update(balancing={"weights": [1]}),
+])
+def test_incomplete_config_is_rejected(raw, break_config):
+    broken = copy.deepcopy(raw)
+    break_config(broken)
+    with pytest.raises(ValueError):
+        compile_routing(broken)
+
+
+def test_bad_reload_keeps_current_routing(raw, tmp_path, monkeypatch):
+    import api.main as main
+
+    broken = copy.deepcopy(raw)
+    broken["providers"].pop("bgmi")
+    path = tmp_path / "routing.json"
+    path.write_text(json.dumps(broken))
+    monkeypatch.setattr(main, "ROUTING_CONFIG", str(path))
+
+    current = main.ROUTING
+    assert not main.reload_routing()
+    assert main.ROUTING is current
+    assert "bgmi" in main.routing_state["last_error"]
@@ -0,0 +1,126 @@
+import multiprocessing
+import struct
+import time
+
+from api.main import SharedLookupCache, SharedMemoryTable
+
+COUNTER = struct.Struct("<Q")
+
+
+def open_table(tmp_path, slots=64, slot_bytes=128):
+    return SharedMemoryTable(str(tmp_path / "table"), slots, slot_bytes, 4)
+
+
+def test_set_get_round_trip(tmp_path):
+    table = open_table(tmp_path)
+    expires = time.time() + 60
+    assert table.set(b"key", b"value", expires)
+    assert table.get(b"key") == (expires, b"value")
+    assert table.get(b"other") is None
+
+    assert table.set(b"key", b"newer", expires)
+    assert table.get(b"key")[1] == b"newer"
+
+
+def test_expired_entries_are_not_returned(tmp_path):
+    table = open_table(tmp_path)
+    table.set(b"old", b"value", time.time() - 1)
+    assert table.get(b"old") is None
+    assert table.update(b"old", lambda current: (current, None, 0)) is None
+
+
+def test_oversized_entries_are_not_stored(tmp_path):
+    table = open_table(tmp_path, slot_bytes=64)
+    assert not table.set(b"key", b"x" * 64, time.time() + 60)
+    assert table.get(b"key") is None
+
+
+def test_full_bucket_evicts_soonest_expiring(tmp_path):
+    table = open_table(tmp_path, slots=8)       # a single bucket
+    now = time.time()
+    for n in range(8):
+        table.set(b"key%d" % n, b"v", now + 100 + n)
+    table.set(b"key0", b"v", now + 200)         # overwriting uses the same slot
+    table.set(b"new", b"v", now + 300)
+
+    assert table.get(b"key1") is None
+    assert table.get(b"new") is not None
+    assert all(table.get(b"key%d" % n) is not None for n in (0, 2, 3, 4, 5, 6, 7))
+
+
+def test_full_bucket_reuses_expired_slots_first(tmp_path):
+    table = open_table(tmp_path, slots=8)
+    now = time.time()
+    for n in range(8):
+        table.set(b"key%d" % n, b"v", now + 100 + n)
+    table.set(b"key5", b"v", now - 1)
+    table.set(b"new", b"v", now + 50)
+
+    assert table.get(b"new") is not None
+    assert all(table.get(b"key%d" % n) is not None for n in (0, 1, 2, 3, 4, 6, 7))
+
+
+def test_update_is_read_modify_write(tmp_path):
+    table = open_table(tmp_path)
+
+    def increment(current):
+        value = COUNTER.unpack(current)[0] + 1 if current else 1
+        return value, COUNTER.pack(value), time.time() + 60
+
+    assert [table.update(b"n", increment) for _ in range(3)] == [1, 2, 3]
+    # returning no new value leaves the entry alone
+    assert table.update(b"n", lambda current: (current, None, 0)) == COUNTER.pack(3)
+    assert table.get(b"n")[1] == COUNTER.pack(3)
+
+
+def test_reopening_attaches_to_existing_data(tmp_path):
+    open_table(tmp_path).set(b"key", b"value", time.time() + 60)
+    assert open_table(tmp_path).get(b"key")[1] == b"value"
+    # another geometry is another file, never a misread of this one
+    assert open_table(tmp_path, slots=128).get(b"key") is None
+
+
+def test_corrupt_header_resets_the_table(tmp_path):
+    table = open_table(tmp_path)
+    table.set(b"key", b"value", time.time() + 60)
+    with open(table.path, "r+b") as f:
+        f.write(b"garbage!")
+    assert open_table(tmp_path).get(b"key") is None
+
+
+def test_lookup_cache_round_trip(tmp_path):
+    cache = SharedLookupCache(open_table(tmp_path, slot_bytes=256))
+    result = {"code": 200, "status": True, "message": "", "data": {"username": "名前", "zone": None}}
+    cache.set(("bgmi", "1", None), result, 60)
+    left, value = cache.peek(("bgmi", "1", None))
+    assert value == result and 59 < left <= 60
+
+    cache.set(("bgmi", "2", None), {"data": "x" * 500}, 60)    # too big for a slot
+    assert cache.get(("bgmi", "2", None)) is None
+    cache.set(("bgmi", "3", None), result, 0)
+    assert cache.get(("bgmi", "3", None)) is None
+
+
+def increment_many(path, times):
+    table = SharedMemoryTable(path, 64, 128, 4)
+
+    def increment(current):
+        value = COUNTER.unpack(current)[0] + 1 if current else 1
+        return value, COUNTER.pack(value), time.time() + 60
+
+    for _ in range(times):
+        table.update(b"counter", increment)
+
+
+def test_updates_are_atomic_across_processes(tmp_path):
+    path = str(tmp_path / "table")
+    SharedMemoryTable(path, 64, 128, 4)
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=increment_many, args=(path, 500)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(30)
+        assert worker.exitcode == 0
+
+    assert SharedMemoryTable(path, 64, 128, 4).get(b"counter")[1] == COUNTER.pack(2000)
@@ -0,0 +1,20 @@
+from fastapi.testclient import TestClient
+
+from api.main import app, validate_lookup
+
+client = TestClient(app)
+
+
+def test_non_ascii_digits_are_rejected():
+    assert validate_lookup("ml_ign", "١٢٣٤٥٦", "1234")[1] == "id_format"
+    assert validate_lookup("bgmi", "５１２３４５６")[1] == "id_format"
+    assert validate_lookup("ml_ign", "123456", "١٢٣٤")[1] == "zone_format"
+    assert validate_lookup("ml_ign", "123456", "1234") is None
+
+
+def test_digit_like_zone_is_a_400_not_a_500():
+    assert validate_lookup("ml_ign", "123456", "²")[1] == "zone_format"
+
+    response = client.get("/games/ml_ign", params={"id": "123456", "zone": "²"})
+    assert response.status_code == 400
+    assert response.json()["data"] == {"field": "zone", "rule": "zone_format"}